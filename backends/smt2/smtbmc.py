@@ -17,10 +17,10 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
-import os, sys, getopt, re
+import os, sys, getopt, re, json, gzip, atexit, cProfile, pstats, threading
 ##yosys-sys-path##
-from smtio import smtio, smtopts, mkvcd
-from collections import defaultdict
+from smtio import smtio, smtpool, smtopts, smtabort, mkvcd, file_sha256
+from collections import defaultdict, deque
 
 skip_steps = 0
 step_size = 1
@@ -31,10 +31,23 @@ inconstr = list()
 outconstr = None
 gentrace = False
 tempind = False
+prove = False
 dumpall = False
 assume_skipped = None
 final_only = False
 topmod = None
+proven_steps = None
+cprofile = None
+checkpoint = None
+resume = False
+bmc_depth = 0
+induction_depth = None
+prove_stop = False
+print_lock = threading.RLock()
+ind = None
+jobs = 1
+split_asserts = False
+pool = None
 so = smtopts()
 
 
@@ -42,6 +55,12 @@ def usage():
     print("""
 yosys-smtbmc [options] <yosys_smt2_output>
 
+    the input file may be compressed with gzip (.gz), xz (.xz)
+    or, if supported by the Python version, zstd (.zst).
+
+    exit status is 0 for PASSED, 1 for FAILED and 2 for UNKNOWN
+    (a time limit was reached or the solver was stopped).
+
     -t <num_steps>
     -t <skip_steps>:<num_steps>
     -t <skip_steps>:<step_size>:<num_steps>
@@ -54,8 +73,29 @@ yosys-smtbmc [options] <yosys_smt2_output>
     -i
         instead of BMC run temporal induction
 
+    --prove
+        run BMC and temporal induction at the same time in two
+        solver processes. PASSED once induction succeeds for some
+        depth and BMC has covered it, FAILED as soon as BMC finds
+        a counterexample.
+
+    --jobs <N>
+        run BMC in N solver processes. the steps are handed out in
+        order to the processes, each one unrolls up to its steps and
+        checks only those. the earliest failing step is reported.
+
+    --split-asserts
+        check each assert in the design and each assert from the
+        --smtc files on its own, and report the result per assert.
+        with --jobs N the asserts are split into N groups that are
+        checked in parallel. an assert that passed in a step is
+        assumed in the later steps of its group, a failed one is
+        dropped. a trace is written for the first failure, or for
+        each failed assert if the dump filename contains '%'.
+
     -m <module_name>
-        name of the top module
+        name of the top module. only this module and the modules
+        instantiated below it are sent to the solver.
 
     --smtc <constr_filename>
         read constraints file
@@ -71,7 +111,8 @@ yosys-smtbmc [options] <yosys_smt2_output>
     --dump-vcd <vcd_filename>
         write trace to this VCD file
         (hint: use 'write_smt2 -wires' for maximum
-        coverage of signals in generated VCD file)
+        coverage of signals in generated VCD file).
+        the file is gzip compressed if the name ends in .gz
 
     --dump-vlogtb <verilog_filename>
         write trace as Verilog test bench
@@ -83,13 +124,26 @@ yosys-smtbmc [options] <yosys_smt2_output>
         when using -g or -i, create a dump file for each
         step. The character '%' is replaces in all dump
         filenames with the step number.
+
+    --checkpoint <filename>
+        in BMC, record the last step up to which all asserts
+        have been proven in this file after each step.
+
+    --resume
+        continue a BMC run from the --checkpoint file: the steps
+        proven there are skipped and their asserts are assumed.
+        this also works with a larger -t than before.
+
+    --cprofile <filename>
+        profile smtbmc itself with cProfile and write the
+        stats to this file (read with python3 -m pstats)
 """ + so.helpmsg())
     sys.exit(1)
 
 
 try:
     opts, args = getopt.getopt(sys.argv[1:], so.shortopts + "t:igm:", so.longopts +
-            ["final-only", "assume-skipped=", "smtc=", "dump-vcd=", "dump-vlogtb=", "dump-smtc=", "dump-all"])
+            ["final-only", "assume-skipped=", "smtc=", "dump-vcd=", "dump-vlogtb=", "dump-smtc=", "dump-all", "cprofile=", "checkpoint=", "resume", "prove", "jobs=", "split-asserts"])
 except:
     usage()
 
@@ -121,8 +175,20 @@ for o, a in opts:
         outconstr = a
     elif o == "--dump-all":
         dumpall = True
+    elif o == "--cprofile":
+        cprofile = a
+    elif o == "--checkpoint":
+        checkpoint = a
+    elif o == "--resume":
+        resume = True
     elif o == "-i":
         tempind = True
+    elif o == "--prove":
+        prove = True
+    elif o == "--jobs":
+        jobs = int(a)
+    elif o == "--split-asserts":
+        split_asserts = True
     elif o == "-g":
         gentrace = True
     elif o == "-m":
@@ -136,10 +202,73 @@ if len(args) != 1:
     usage()
 
 
+# Before Python 3.12 cProfile only sees the thread that enabled it, so the
+# --jobs, --prove and --split-asserts worker threads get a profiler each,
+# merged into the dump. Since 3.12 the main profiler covers all threads and
+# refuses a second one.
+profiler = None
+thread_profilers = list()
+if cprofile is not None:
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def profiled(target):
+    if profiler is None:
+        return target
+    def run(*args):
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            return target(*args)
+        thread_profilers.append(thread_profiler)
+        try:
+            return target(*args)
+        finally:
+            thread_profiler.disable()
+    return run
+
+def write_profiles():
+    if profiler is not None:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        for thread_profiler in thread_profilers:
+            stats.add(thread_profiler)
+        stats.dump_stats(cprofile)
+    if so.profile_trace is not None:
+        so.profile.write(so.profile_trace)
+
+atexit.register(write_profiles)
+
+
 if tempind and len(inconstr) != 0:
     print("Error: options -i and --smtc are exclusive.");
     sys.exit(1)
 
+if prove and (tempind or gentrace or final_only or dumpall or len(inconstr) != 0 or checkpoint is not None):
+    print("Error: option --prove can not be combined with -i, -g, --smtc, --final-only, --dump-all or --checkpoint.");
+    sys.exit(1)
+
+if prove and skip_steps != 0:
+    print("Error: option --prove needs BMC from step 0, skipping steps is not supported.");
+    sys.exit(1)
+
+if jobs > 1 and (tempind or gentrace or prove):
+    print("Error: option --jobs can only be used with BMC.");
+    sys.exit(1)
+
+if split_asserts and (tempind or gentrace or prove or final_only or checkpoint is not None):
+    print("Error: option --split-asserts can not be combined with -i, -g, --prove, --final-only or --checkpoint.");
+    sys.exit(1)
+
+if (tempind or gentrace) and checkpoint is not None:
+    print("Error: option --checkpoint can only be used with BMC.");
+    sys.exit(1)
+
+if resume and checkpoint is None:
+    print("Error: option --resume requires --checkpoint.");
+    sys.exit(1)
+
 
 constr_final_start = None
 constr_asserts = defaultdict(list)
@@ -149,7 +278,7 @@ for fn in inconstr:
     current_states = None
     current_line = 0
 
-    with open(fn, "r") as f:
+    with open(fn, "r") as f, so.profile.span("read constraints", file=fn):
         for line in f:
             current_line += 1
 
@@ -228,62 +357,92 @@ for fn in inconstr:
 
             assert 0
 
+if split_asserts and constr_final_start is not None:
+    print("Error: final constraints are not supported with --split-asserts.");
+    sys.exit(1)
 
-def get_constr_expr(db, state, final=False, getvalues=False):
-    if final:
-        if ("final-%d" % state) not in db:
-            return ([], [], []) if getvalues else "true"
-    else:
-        if state not in db:
-            return ([], [], []) if getvalues else "true"
 
-    netref_regex = re.compile(r'(^|[( ])\[(-?[0-9]+:|)([^\]]+)\](?=[ )]|$)')
+def get_constr_expr(smt, db, state, final=False, getexprs=False):
+    with so.profile.span("constraints"):
+        if final:
+            if ("final-%d" % state) not in db:
+                return ([], [], []) if getexprs else "true"
+        else:
+            if state not in db:
+                return ([], [], []) if getexprs else "true"
 
-    def replace_netref(match):
-        state_sel = match.group(2)
+        netref_regex = re.compile(r'(^|[( ])\[(-?[0-9]+:|)([^\]]+)\](?=[ )]|$)')
 
-        if state_sel == "":
-            st = state
-        elif state_sel[0] == "-":
-            st = state + int(state_sel[:-1])
-        else:
-            st = int(state_sel[:-1])
+        def replace_netref(match):
+            state_sel = match.group(2)
 
-        expr = smt.net_expr(topmod, "s%d" % st, smt.get_path(topmod, match.group(3)))
+            if state_sel == "":
+                st = state
+            elif state_sel[0] == "-":
+                st = state + int(state_sel[:-1])
+            else:
+                st = int(state_sel[:-1])
 
-        return match.group(1) + expr
+            expr = smt.net_expr(topmod, "s%d" % st, smt.get_path(topmod, match.group(3)))
 
-    expr_list = list()
-    for loc, expr in db[("final-%d" % state) if final else state]:
-        actual_expr = netref_regex.sub(replace_netref, expr)
-        if getvalues:
-            expr_list.append((loc, expr, actual_expr))
-        else:
-            expr_list.append(actual_expr)
+            return match.group(1) + expr
+
+        expr_list = list()
+        for loc, expr in db[("final-%d" % state) if final else state]:
+            actual_expr = netref_regex.sub(replace_netref, expr)
+            if getexprs:
+                expr_list.append((loc, expr, actual_expr))
+            else:
+                expr_list.append(actual_expr)
 
-    if getvalues:
-        loc_list, expr_list, acual_expr_list = zip(*expr_list)
-        value_list = smt.get_list(acual_expr_list)
-        return loc_list, expr_list, value_list
+        if getexprs:
+            return tuple(zip(*expr_list))
 
-    if len(expr_list) == 0:
-        return "true"
+        if len(expr_list) == 0:
+            return "true"
 
-    if len(expr_list) == 1:
-        return expr_list[0]
+        if len(expr_list) == 1:
+            return expr_list[0]
 
-    return "(and %s)" % " ".join(expr_list)
+        return "(and %s)" % " ".join(expr_list)
 
 
-smt = smtio(opts=so)
+# a solver session died: the result is not known, stop all sessions
+def solver_aborted(e):
+    if e is not None:
+        print("%s %s" % (smt.timestamp(), e))
+    for s in [smt] if pool is None else pool.sessions:
+        s.kill()
+    print("%s Status: UNKNOWN" % smt.timestamp())
+    sys.exit(2)
 
-print("%s Solver: %s" % (smt.timestamp(), so.solver))
-smt.setup("QF_AUFBV")
 
-with open(args[0], "r") as f:
-    for line in f:
-        smt.write(line)
-        smt.info(line)
+if prove or jobs > 1:
+    # all threads log progress, keep their lines whole
+    builtin_print = print
+
+    def print(*args, **kwargs):
+        with print_lock:
+            builtin_print(*args, **kwargs)
+
+    pool = smtpool(jobs if jobs > 1 else 2, so)
+    smt = pool.sessions[0]
+    if prove:
+        ind = pool.sessions[1]
+    print("%s Solver: %s" % (smt.timestamp(), so.solver))
+    try:
+        pool.load_design(args[0], topmod)
+    except smtabort as e:
+        solver_aborted(e)
+
+else:
+    smt = smtio(opts=so)
+    print("%s Solver: %s" % (smt.timestamp(), so.solver))
+    try:
+        smt.setup("QF_AUFBV")
+        smt.load_design(args[0], topmod)
+    except smtabort as e:
+        solver_aborted(e)
 
 if topmod is None:
     topmod = smt.topmod
@@ -292,13 +451,61 @@ assert topmod is not None
 assert topmod in smt.modinfo
 
 
-def write_vcd_trace(steps_start, steps_stop, index):
+# the proven depth is only meaningful for the same design, top module and
+# constraint files. the number of steps is not part of the key, so a run
+# can be resumed with a larger -t.
+checkpoint_key = None
+checkpoint_depth = -1
+
+if checkpoint is not None:
+    checkpoint_key = {
+        "design": file_sha256(args[0]).hexdigest(),
+        "topmod": topmod,
+        "constraints": [file_sha256(fn).hexdigest() for fn in inconstr],
+        "final_only": final_only,
+    }
+
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint, "r") as f:
+            data = json.load(f)
+        if data["key"] == checkpoint_key:
+            print("%s Resuming from checkpoint %s: steps 0 to %d passed." % (smt.timestamp(), checkpoint, data["depth"]))
+            checkpoint_depth = data["depth"]
+            if checkpoint_depth >= skip_steps:
+                skip_steps = checkpoint_depth + 1
+                assume_skipped = 0
+        else:
+            print("%s Checkpoint %s does not match this design and options, starting from step 0." % (smt.timestamp(), checkpoint))
+
+def write_checkpoint(depth):
+    with open(checkpoint + ".tmp", "w") as f:
+        json.dump({"key": checkpoint_key, "depth": depth}, f)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+# the net values of each step of a trace, with at most trace_window get-value
+# queries in flight so the replies for a long trace do not pile up unread
+trace_window = 16
+
+def trace_values(smt, net_list, steps_start, steps_stop):
+    futures = deque()
+    for i in range(steps_start, steps_stop):
+        futures.append((i, smt.get_net_list_future(topmod, net_list, "s%d" % i)))
+        if len(futures) == trace_window:
+            i, future = futures.popleft()
+            yield i, future.result()
+    for i, future in futures:
+        yield i, future.result()
+
+
+def write_vcd_trace(smt, steps_start, steps_stop, index):
     filename = vcdfile.replace("%", index)
     print("%s Writing trace to VCD file: %s" % (smt.timestamp(), filename))
 
-    with open(filename, "w") as vcd_file:
+    with (gzip.open(filename, "wt") if filename.endswith(".gz") else open(filename, "w")) as vcd_file:
         vcd = mkvcd(vcd_file)
         path_list = list()
+        handles = list()
 
         for netpath in sorted(smt.hiernets(topmod)):
             hidden_net = False
@@ -306,19 +513,19 @@ def write_vcd_trace(steps_start, steps_stop, index):
                 if n.startswith("$"):
                     hidden_net = True
             if not hidden_net:
-                vcd.add_net([topmod] + netpath, smt.net_width(topmod, netpath))
+                handles.append(vcd.add_net([topmod] + netpath, smt.net_width(topmod, netpath)))
                 path_list.append(netpath)
 
-        for i in range(steps_start, steps_stop):
+        for i, values in trace_values(smt, path_list, steps_start, steps_stop):
             vcd.set_time(i)
-            value_list = smt.get_net_bin_list(topmod, path_list, "s%d" % i)
-            for path, value in zip(path_list, value_list):
-                vcd.set_net([topmod] + path, value)
+            value_list = smt.decode_list(values, "bin")
+            for handle, value in zip(handles, value_list):
+                vcd.set_net(handle, value)
 
         vcd.set_time(steps_stop)
 
 
-def write_vlogtb_trace(steps_start, steps_stop, index):
+def write_vlogtb_trace(smt, steps_start, steps_stop, index):
     filename = vlogtbfile.replace("%", index)
     print("%s Writing trace to Verilog testbench: %s" % (smt.timestamp(), filename))
 
@@ -383,21 +590,18 @@ def write_vlogtb_trace(steps_start, steps_stop, index):
                 for j in range(ports):
                     addr_expr_list.append(smt.mem_expr(topmod, "s%d" % i, mempath, j))
 
-            addr_list = set()
-            for val in smt.get_list(addr_expr_list):
-                addr_list.add(smt.bv2int(val))
+            addr_list = set(smt.decode_list(smt.get_list(addr_expr_list), "int"))
 
             expr_list = list()
             for i in addr_list:
                 expr_list.append("(select %s #b%s)" % (mem, format(i, "0%db" % abits)))
 
-            for i, val in zip(addr_list, smt.get_list(expr_list)):
-                val = smt.bv2bin(val)
+            for i, val in zip(addr_list, smt.decode_list(smt.get_list(expr_list), "bin")):
                 print("    UUT.%s[%d] = %d'b%s;" % (".".join(mempath), i, len(val), val), file=f)
 
-        for i in range(steps_start, steps_stop):
-            pi_names = [[name] for name, _ in primary_inputs if name not in clock_inputs]
-            pi_values = smt.get_net_bin_list(topmod, pi_names, "s%d" % i)
+        pi_names = [[name] for name, _ in primary_inputs if name not in clock_inputs]
+        for i, values in trace_values(smt, pi_names, steps_start, steps_stop):
+            pi_values = smt.decode_list(values, "bin")
 
             print("    #1;", file=f);
             print("    // state %d" % i, file=f);
@@ -412,7 +616,7 @@ def write_vlogtb_trace(steps_start, steps_stop, index):
         print("endmodule", file=f)
 
 
-def write_constr_trace(steps_start, steps_stop, index):
+def write_constr_trace(smt, steps_start, steps_stop, index):
     filename = outconstr.replace("%", index)
     print("%s Writing trace to constraints file: %s" % (smt.timestamp(), filename))
 
@@ -445,9 +649,7 @@ def write_constr_trace(steps_start, steps_stop, index):
                 for j in range(ports):
                     addr_expr_list.append(smt.mem_expr(topmod, "s%d" % i, mempath, j))
 
-            addr_list = set()
-            for val in smt.get_list(addr_expr_list):
-                addr_list.add(smt.bv2int(val))
+            addr_list = set(smt.decode_list(smt.get_list(addr_expr_list), "int"))
 
             expr_list = list()
             for i in addr_list:
@@ -457,121 +659,165 @@ def write_constr_trace(steps_start, steps_stop, index):
                 print("assume (= (select [%s] #b%s) %s)" % (".".join(mempath), format(i, "0%db" % abits), val), file=f)
 
 
-        for k in range(steps_start, steps_stop):
+        pi_names = [[name] for name, _ in sorted(primary_inputs)]
+        for k, pi_values in trace_values(smt, pi_names, steps_start, steps_stop):
             print("", file=f)
             print("state %d" % k, file=f)
 
-            pi_names = [[name] for name, _ in sorted(primary_inputs)]
-            pi_values = smt.get_net_list(topmod, pi_names, "s%d" % k)
-
             for name, val in zip(pi_names, pi_values):
                 print("assume (= [%s] %s)" % (".".join(name), val), file=f)
 
 
-def write_trace(steps_start, steps_stop, index):
+def write_trace(smt, steps_start, steps_stop, index):
     if vcdfile is not None:
-        write_vcd_trace(steps_start, steps_stop, index)
+        with so.profile.span("write vcd"):
+            write_vcd_trace(smt, steps_start, steps_stop, index)
 
     if vlogtbfile is not None:
-        write_vlogtb_trace(steps_start, steps_stop, index)
+        with so.profile.span("write vlogtb"):
+            write_vlogtb_trace(smt, steps_start, steps_stop, index)
 
     if outconstr is not None:
-        write_constr_trace(steps_start, steps_stop, index)
-
-
-def print_failed_asserts_worker(mod, state, path):
-    assert mod in smt.modinfo
-
-    if smt.get("(|%s_a| %s)" % (mod, state)) == "true":
-        return
-
-    for cellname, celltype in smt.modinfo[mod].cells.items():
-        print_failed_asserts_worker(celltype, "(|%s_h %s| %s)" % (mod, cellname, state), path + "." + cellname)
-
-    for assertfun, assertinfo in smt.modinfo[mod].asserts.items():
-        if smt.get("(|%s| %s)" % (assertfun, state)) == "false":
-            print("%s Assert failed in %s: %s" % (smt.timestamp(), path, assertinfo))
-
-
-def print_failed_asserts(state, final=False):
-    loc_list, expr_list, value_list = get_constr_expr(constr_asserts, state, final=final, getvalues=True)
-
-    for loc, expr, value in zip(loc_list, expr_list, value_list):
-        if smt.bv2int(value) == 0:
-            print("%s Assert %s failed: %s" % (smt.timestamp(), loc, expr))
-
-    if not final:
-        print_failed_asserts_worker(topmod, "s%d" % state, topmod)
-
-
-def print_anyconsts_worker(mod, state, path):
-    assert mod in smt.modinfo
-
-    for cellname, celltype in smt.modinfo[mod].cells.items():
-        print_anyconsts_worker(celltype, "(|%s_h %s| %s)" % (mod, cellname, state), path + "." + cellname)
-
-    for fun, info in smt.modinfo[mod].anyconsts.items():
-        print("%s Value for anyconst in %s (%s): %d" % (smt.timestamp(), path, info, smt.bv2int(smt.get("(|%s| %s)" % (fun, state)))))
-
-
-def print_anyconsts(state):
-    print_anyconsts_worker(topmod, "s%d" % state, topmod)
+        with so.profile.span("write constr"):
+            write_constr_trace(smt, steps_start, steps_stop, index)
+
+
+# Every anyconst and assert function in the hierarchy, as (kind, path, info,
+# function, state prefix, state suffix), built once with the state wrappers
+# from the hierarchy index. The report order is cells first, then the
+# module's own entries, as in the design file. print_diagnostics() evaluates
+# them together with the --smtc asserts of a state in a single get_list.
+diag_lock = threading.Lock()
+diag_entries = None
+
+def diag_entries_worker(smt, index, mod, cursor):
+    info = smt.modinfo[mod]
+
+    for cellname, celltype in info.cells.items():
+        diag_entries_worker(smt, index, celltype, cursor + (cellname,))
+
+    path = ".".join((topmod,) + cursor)
+    for kind, funs, entrymap in (("assert", info.asserts, index.assertmap), ("anyconst", info.anyconsts, index.anyconstmap)):
+        for fun in funs:
+            entryinfo, (leafmod, prefix, suffix) = entrymap[(cursor, fun)]
+            diag_entries.append((kind, path, entryinfo, fun, prefix, suffix))
+
+def get_diag_entries(smt):
+    global diag_entries
+    with diag_lock:
+        if diag_entries is None:
+            index = smt.hierindex(topmod)
+            diag_entries = list()
+            diag_entries_worker(smt, index, topmod, ())
+    return diag_entries
+
+
+def print_diagnostics(smt, state, anyconsts=False, asserts=True, final=False):
+    with so.profile.span("diagnostics", step=state):
+        kinds = set()
+        if anyconsts:
+            kinds.add("anyconst")
+        if asserts and not final:
+            kinds.add("assert")
+        entries = [entry for entry in get_diag_entries(smt) if entry[0] in kinds]
+
+        loc_list, expr_list, constr_list = ([], [], [])
+        if asserts:
+            loc_list, expr_list, constr_list = get_constr_expr(smt, constr_asserts, state, final=final, getexprs=True)
+
+        values = smt.get_list(list(constr_list) + ["(|%s| %s%s%s)" % (fun, prefix, "s%d" % state, suffix) for _, _, _, fun, prefix, suffix in entries])
+        constr_values, values = values[:len(constr_list)], values[len(constr_list):]
+
+        for (kind, path, info, _, _, _), value in zip(entries, values):
+            if kind == "anyconst":
+                print("%s Value for anyconst in %s (%s): %d" % (smt.timestamp(), path, info, smt.bv2int(value)))
+
+        for loc, expr, value in zip(loc_list, expr_list, constr_values):
+            if smt.bv2int(value) == 0:
+                print("%s Assert %s failed: %s" % (smt.timestamp(), loc, expr))
+
+        for (kind, path, info, _, _, _), value in zip(entries, values):
+            if kind == "assert" and value == "false":
+                print("%s Assert failed in %s: %s" % (smt.timestamp(), path, info))
+
+
+# --prove: once BMC failed the induction thread stops and prints nothing more,
+# prove_stop is set under print_lock before the failure is reported
+def induction_print(smt, msg):
+    with print_lock:
+        if prove_stop:
+            return False
+        print("%s %s" % (smt.timestamp(), msg))
+        return True
+
+def stop_induction():
+    global prove_stop
+    with print_lock:
+        prove_stop = True
+    ind.kill()
+
+
+def induction(smt):
+    global induction_depth
 
-
-if tempind:
     retstatus = False
     skip_counter = step_size
     for step in range(num_steps, -1, -1):
-        smt.write("(declare-fun s%d () %s_s)" % (step, topmod))
-        smt.write("(assert (%s_u s%d))" % (topmod, step))
-        smt.write("(assert (%s_h s%d))" % (topmod, step))
-        smt.write("(assert (not (%s_is s%d)))" % (topmod, step))
+        with so.profile.span("unroll", step=step):
+            smt.write("(declare-fun s%d () %s_s)" % (step, topmod))
+            smt.write("(assert (%s_u s%d))" % (topmod, step))
+            smt.write("(assert (%s_h s%d))" % (topmod, step))
+            smt.write("(assert (not (%s_is s%d)))" % (topmod, step))
 
-        if step == num_steps:
-            smt.write("(assert (not (%s_a s%d)))" % (topmod, step))
+            if step == num_steps:
+                smt.write("(assert (not (%s_a s%d)))" % (topmod, step))
 
-        else:
-            smt.write("(assert (%s_t s%d s%d))" % (topmod, step, step+1))
-            smt.write("(assert (%s_a s%d))" % (topmod, step))
+            else:
+                smt.write("(assert (%s_t s%d s%d))" % (topmod, step, step+1))
+                smt.write("(assert (%s_a s%d))" % (topmod, step))
 
         if step > num_steps-skip_steps:
-            print("%s Skipping induction in step %d.." % (smt.timestamp(), step))
+            if not induction_print(smt, "Skipping induction in step %d.." % step):
+                break
             continue
 
         skip_counter += 1
         if skip_counter < step_size:
-            print("%s Skipping induction in step %d.." % (smt.timestamp(), step))
+            if not induction_print(smt, "Skipping induction in step %d.." % step):
+                break
             continue
 
         skip_counter = 0
-        print("%s Trying induction in step %d.." % (smt.timestamp(), step))
+        if not induction_print(smt, "Trying induction in step %d.." % step):
+            break
+        smt.stats_mode, smt.stats_step = "induction", step
 
         if smt.check_sat() == "sat":
             if step == 0:
-                print("%s Temporal induction failed!" % smt.timestamp())
-                print_anyconsts(num_steps)
-                print_failed_asserts(num_steps)
-                write_trace(step, num_steps+1, '%')
+                induction_print(smt, "Temporal induction failed!")
+                if not prove:
+                    print_diagnostics(smt, num_steps, anyconsts=True)
+                    write_trace(smt, step, num_steps+1, '%')
 
             elif dumpall:
-                print_anyconsts(num_steps)
-                print_failed_asserts(num_steps)
-                write_trace(step, num_steps+1, "%d" % step)
+                print_diagnostics(smt, num_steps, anyconsts=True)
+                write_trace(smt, step, num_steps+1, "%d" % step)
 
         else:
-            print("%s Temporal induction successful." % smt.timestamp())
+            induction_print(smt, "Temporal induction successful.")
+            induction_depth = num_steps - step
             retstatus = True
             break
 
+    return retstatus
 
-else: # not tempind
-    step = 0
-    retstatus = True
-    while step < num_steps:
+
+def bmc_unroll(smt, step):
+    with so.profile.span("unroll", step=step):
         smt.write("(declare-fun s%d () %s_s)" % (step, topmod))
         smt.write("(assert (%s_u s%d))" % (topmod, step))
         smt.write("(assert (%s_h s%d))" % (topmod, step))
-        smt.write("(assert %s)" % get_constr_expr(constr_assumes, step))
+        smt.write("(assert %s)" % get_constr_expr(smt, constr_assumes, step))
 
         if step == 0:
             smt.write("(assert (%s_i s0))" % (topmod))
@@ -581,11 +827,69 @@ else: # not tempind
             smt.write("(assert (%s_t s%d s%d))" % (topmod, step-1, step))
             smt.write("(assert (not (%s_is s%d)))" % (topmod, step))
 
+
+def bmc_assume_asserts(smt, step):
+    smt.write("(assert (%s_a s%d))" % (topmod, step))
+    smt.write("(assert %s)" % get_constr_expr(smt, constr_asserts, step))
+
+
+def bmc_check_asserts(smt, step, last_check_step):
+    if last_check_step == step:
+        print("%s Checking asserts in step %d.." % (smt.timestamp(), step))
+    else:
+        print("%s Checking asserts in steps %d to %d.." % (smt.timestamp(), step, last_check_step))
+    smt.write("(push 1)")
+    smt.stats_mode, smt.stats_step = "bmc", step
+
+    smt.write("(assert (not (and %s)))" % " ".join(["(%s_a s%d)" % (topmod, i) for i in range(step, last_check_step+1)] +
+            [get_constr_expr(smt, constr_asserts, i) for i in range(step, last_check_step+1)]))
+
+    if smt.check_sat() == "sat":
+        return False
+
+    smt.write("(pop 1)")
+    return True
+
+
+# returns the first step in which the final constraints fail, or None
+def bmc_check_final(smt, step, last_check_step):
+    for i in range(max(step, constr_final_start), last_check_step+1):
+        print("%s Checking final constraints in step %d.." % (smt.timestamp(), i))
+        smt.write("(push 1)")
+        smt.stats_mode, smt.stats_step = "final", i
+
+        smt.write("(assert %s)" % get_constr_expr(smt, constr_assumes, i, final=True))
+        smt.write("(assert (not %s))" % get_constr_expr(smt, constr_asserts, i, final=True))
+
+        if smt.check_sat() == "sat":
+            return i
+
+        smt.write("(pop 1)")
+
+    return None
+
+
+def bmc_failed(smt, step, last_check_step, final=False):
+    if prove:
+        stop_induction()
+    print("%s BMC failed!" % smt.timestamp())
+    for i in range(step, last_check_step+1):
+        print_diagnostics(smt, i, anyconsts=(i == step), final=final)
+    write_trace(smt, 0, last_check_step+1, '%')
+
+
+def bmc(smt):
+    global proven_steps, checkpoint_depth, bmc_depth
+
+    step = 0
+    retstatus = True
+    while step < num_steps:
+        bmc_unroll(smt, step)
+
         if step < skip_steps:
             if assume_skipped is not None and step >= assume_skipped:
                 print("%s Skipping step %d (and assuming pass).." % (smt.timestamp(), step))
-                smt.write("(assert (%s_a s%d))" % (topmod, step))
-                smt.write("(assert %s)" % get_constr_expr(constr_asserts, step))
+                bmc_assume_asserts(smt, step)
             else:
                 print("%s Skipping step %d.." % (smt.timestamp(), step))
             step += 1
@@ -598,82 +902,379 @@ else: # not tempind
                 smt.write("(assert (%s_u s%d))" % (topmod, step+i))
                 smt.write("(assert (%s_h s%d))" % (topmod, step+i))
                 smt.write("(assert (%s_t s%d s%d))" % (topmod, step+i-1, step+i))
-                smt.write("(assert %s)" % get_constr_expr(constr_assumes, step+i))
+                smt.write("(assert %s)" % get_constr_expr(smt, constr_assumes, step+i))
                 last_check_step = step+i
 
         if not gentrace:
             if not final_only:
-                if last_check_step == step:
-                    print("%s Checking asserts in step %d.." % (smt.timestamp(), step))
-                else:
-                    print("%s Checking asserts in steps %d to %d.." % (smt.timestamp(), step, last_check_step))
-                smt.write("(push 1)")
-
-                smt.write("(assert (not (and %s)))" % " ".join(["(%s_a s%d)" % (topmod, i) for i in range(step, last_check_step+1)] +
-                        [get_constr_expr(constr_asserts, i) for i in range(step, last_check_step+1)]))
-
-                if smt.check_sat() == "sat":
-                    print("%s BMC failed!" % smt.timestamp())
-                    print_anyconsts(step)
-                    for i in range(step, last_check_step+1):
-                        print_failed_asserts(i)
-                    write_trace(0, last_check_step+1, '%')
+                if not bmc_check_asserts(smt, step, last_check_step):
+                    bmc_failed(smt, step, last_check_step)
                     retstatus = False
                     break
 
-                smt.write("(pop 1)")
+                proven_steps = (step if proven_steps is None else proven_steps[0], last_check_step)
+
+                if prove and step == bmc_depth:
+                    bmc_depth = last_check_step + 1
+                    if induction_depth is not None and bmc_depth >= max(induction_depth, 1):
+                        break
 
             for i in range(step, last_check_step+1):
-                smt.write("(assert (%s_a s%d))" % (topmod, i))
-                smt.write("(assert %s)" % get_constr_expr(constr_asserts, i))
+                bmc_assume_asserts(smt, i)
 
             if constr_final_start is not None:
-                for i in range(step, last_check_step+1):
-                    if i < constr_final_start:
-                        continue
-
-                    print("%s Checking final constraints in step %d.." % (smt.timestamp(), i))
-                    smt.write("(push 1)")
-
-                    smt.write("(assert %s)" % get_constr_expr(constr_assumes, i, final=True))
-                    smt.write("(assert (not %s))" % get_constr_expr(constr_asserts, i, final=True))
-
-                    if smt.check_sat() == "sat":
-                        print("%s BMC failed!" % smt.timestamp())
-                        print_anyconsts(i)
-                        print_failed_asserts(i, final=True)
-                        write_trace(0, i+1, '%')
-                        retstatus = False
-                        break
-
-                    smt.write("(pop 1)")
-                if not retstatus:
+                i = bmc_check_final(smt, step, last_check_step)
+                if i is not None:
+                    bmc_failed(smt, i, i, final=True)
+                    retstatus = False
                     break
 
+            if checkpoint is not None and step == checkpoint_depth + 1:
+                checkpoint_depth = last_check_step
+                write_checkpoint(checkpoint_depth)
+
         else: # gentrace
             for i in range(step, last_check_step+1):
-                smt.write("(assert (%s_a s%d))" % (topmod, i))
-                smt.write("(assert %s)" % get_constr_expr(constr_asserts, i))
+                bmc_assume_asserts(smt, i)
 
             print("%s Solving for step %d.." % (smt.timestamp(), last_check_step))
+            smt.stats_mode, smt.stats_step = "gentrace", last_check_step
             if smt.check_sat() != "sat":
                 print("%s No solution found!" % smt.timestamp())
                 retstatus = False
                 break
 
             elif dumpall:
-                print_anyconsts(0)
-                write_trace(0, last_check_step+1, "%d" % step)
+                print_diagnostics(smt, 0, anyconsts=True, asserts=False)
+                write_trace(smt, 0, last_check_step+1, "%d" % step)
 
         step += step_size
 
     if gentrace:
-        print_anyconsts(0)
-        write_trace(0, num_steps, '%')
+        print_diagnostics(smt, 0, anyconsts=True, asserts=False)
+        write_trace(smt, 0, num_steps, '%')
+
+    return retstatus
+
+
+# --jobs: the checked steps are split into chunks of step_size steps that are
+# handed out in order to worker threads, each with its own solver session.
+# A worker unrolls its session up to the chunk it got and assumes the asserts
+# in all steps before it. That is sound because those steps are checked by
+# the other workers, and only the earliest failing chunk is reported.
+# Workers busy with later chunks are stopped as soon as a chunk fails.
+jobs_cond = threading.Condition()
+jobs_chunks = list()
+jobs_next = 0
+jobs_active = dict()
+jobs_done = set()
+jobs_proven = 0
+jobs_failed = None
+jobs_error = None
+jobs_stopped = set()
+
+def jobs_stop(index):
+    for i, s in jobs_active.items():
+        if i > index and s not in jobs_stopped:
+            jobs_stopped.add(s)
+            s.kill()
+
+def jobs_passed(index):
+    global jobs_proven, proven_steps, checkpoint_depth
+    jobs_done.add(index)
+    while jobs_proven in jobs_done:
+        jobs_proven += 1
+    if jobs_proven > 0:
+        proven_steps = (jobs_chunks[0][0], jobs_chunks[jobs_proven-1][1])
+        if checkpoint is not None and jobs_chunks[0][0] <= checkpoint_depth + 1 and proven_steps[1] > checkpoint_depth:
+            checkpoint_depth = proven_steps[1]
+            write_checkpoint(checkpoint_depth)
+
+def bmc_worker(smt):
+    global jobs_next, jobs_failed, jobs_error
+
+    unrolled = 0
+    try:
+        while True:
+            with jobs_cond:
+                if jobs_error is not None or jobs_next == len(jobs_chunks) or (jobs_failed is not None and jobs_next > jobs_failed):
+                    return
+                index = jobs_next
+                jobs_next += 1
+                jobs_active[index] = smt
+
+            step, last_check_step = jobs_chunks[index]
+            while unrolled <= last_check_step:
+                bmc_unroll(smt, unrolled)
+                if unrolled < step and (unrolled >= skip_steps or (assume_skipped is not None and unrolled >= assume_skipped)):
+                    bmc_assume_asserts(smt, unrolled)
+                unrolled += 1
+
+            failed = None
+            if not final_only and not bmc_check_asserts(smt, step, last_check_step):
+                failed = (step, last_check_step, False)
+
+            if failed is None:
+                for i in range(step, last_check_step+1):
+                    bmc_assume_asserts(smt, i)
+                if constr_final_start is not None:
+                    i = bmc_check_final(smt, step, last_check_step)
+                    if i is not None:
+                        failed = (i, i, True)
+
+            with jobs_cond:
+                del jobs_active[index]
+                if failed is None:
+                    jobs_passed(index)
+                    jobs_cond.notify_all()
+                    continue
+
+                if jobs_failed is None or index < jobs_failed:
+                    jobs_failed = index
+                    jobs_stop(index)
+                jobs_cond.notify_all()
+
+                # the trace is only written once all earlier chunks passed
+                while jobs_error is None and jobs_failed == index and min(jobs_active, default=index) < index:
+                    jobs_cond.wait()
+                if jobs_error is not None or jobs_failed != index:
+                    return
+
+            bmc_failed(smt, *failed)
+            return
+
+    except smtabort as e:
+        with jobs_cond:
+            if smt in jobs_stopped:
+                return
+            if jobs_error is None:
+                jobs_error = e
+            jobs_stop(-1)
+            jobs_cond.notify_all()
+
+def bmc_jobs():
+    for step in range(0, min(skip_steps, num_steps)):
+        if assume_skipped is not None and step >= assume_skipped:
+            print("%s Skipping step %d (and assuming pass).." % (smt.timestamp(), step))
+        else:
+            print("%s Skipping step %d.." % (smt.timestamp(), step))
+
+    for step in range(skip_steps, num_steps, step_size):
+        jobs_chunks.append((step, min(step+step_size, num_steps)-1))
+
+    threads = [threading.Thread(target=profiled(bmc_worker), args=(s,)) for s in pool.sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if jobs_error is not None:
+        raise jobs_error
+
+    return jobs_failed is None
+
+
+# --split-asserts: every assert in the hierarchy and every assert from the
+# --smtc files is a property of its own. Each session runs the BMC loop for
+# one group of properties and only assumes what it proved itself, so the
+# groups do not have to wait for each other.
+split_lock = threading.Lock()
+split_props = list()
+split_failed = dict()
+split_proven = dict()
+split_traced = False
+split_error = None
+
+def split_properties():
+    for path, assertfun, assertinfo in smt.hierasserts(topmod):
+        expr = lambda smt, step, path=path, assertfun=assertfun: smt.assert_expr(topmod, "s%d" % step, path, assertfun)
+        split_props.append(("%s: %s" % (".".join([topmod] + path), assertinfo), expr))
+
+    smtc_dbs = defaultdict(lambda: defaultdict(list))
+    for state, entries in constr_asserts.items():
+        for loc, expr in entries:
+            smtc_dbs[loc][state].append((loc, expr))
+
+    for loc in sorted(smtc_dbs, key=lambda loc: (loc.rpartition(":")[0], int(loc.rpartition(":")[2]))):
+        db = smtc_dbs[loc]
+        expr = lambda smt, step, db=db: get_constr_expr(smt, db, step)
+        split_props.append(("%s: %s" % (loc, next(iter(db.values()))[0][1]), expr))
+
+def split_worker(smt, group):
+    global split_traced, split_error
+
+    live = list(group)
+    unrolled = 0
+    try:
+        for step in range(skip_steps, num_steps, step_size):
+            last_check_step = min(step+step_size, num_steps) - 1
+            while unrolled <= last_check_step:
+                bmc_unroll(smt, unrolled)
+                if unrolled < skip_steps and assume_skipped is not None and unrolled >= assume_skipped:
+                    bmc_assume_asserts(smt, unrolled)
+                unrolled += 1
+
+            steps = range(step, last_check_step+1)
+            while len(live) != 0:
+                if last_check_step == step:
+                    print("%s Checking %d asserts in step %d.." % (smt.timestamp(), len(live), step))
+                else:
+                    print("%s Checking %d asserts in steps %d to %d.." % (smt.timestamp(), len(live), step, last_check_step))
+                smt.write("(push 1)")
+                smt.stats_mode, smt.stats_step = "bmc", step
+
+                exprs = [expr(smt, i) for index, expr in live for i in steps]
+                smt.write("(assert (not %s))" % (exprs[0] if len(exprs) == 1 else "(and %s)" % " ".join(exprs)))
+
+                if smt.check_sat() != "sat":
+                    smt.write("(pop 1)")
+                    for index, expr in live:
+                        split_proven[index] = last_check_step
+                    break
+
+                values = iter(smt.get_list(exprs))
+                failed = list()
+                for index, expr in live:
+                    fail_steps = [i for i in steps if smt.bv2int(next(values)) == 0]
+                    if len(fail_steps) != 0:
+                        failed.append(index)
+                        split_failed[index] = fail_steps[0]
+                        print("%s Assert %d failed in step %d: %s" % (smt.timestamp(), index, fail_steps[0], split_props[index][0]))
+
+                with split_lock:
+                    per_assert = "%" in "".join([fn for fn in (vcdfile, vlogtbfile, outconstr) if fn is not None])
+                    if per_assert or not split_traced:
+                        split_traced = True
+                        print_diagnostics(smt, step, anyconsts=True, asserts=False)
+                        # the same model is a counterexample for every assert that failed in it
+                        for index in failed if per_assert else failed[:1]:
+                            write_trace(smt, 0, last_check_step+1, "%d" % index if per_assert else '%')
+
+                smt.write("(pop 1)")
+                live = [(index, expr) for index, expr in live if index not in failed]
+
+            for i in steps:
+                for index, expr in live:
+                    smt.write("(assert %s)" % expr(smt, i))
+
+    except smtabort as e:
+        with jobs_cond:
+            if smt in jobs_stopped:
+                return
+            if split_error is None:
+                split_error = e
+            for s in [smt] if pool is None else pool.sessions:
+                if s is not smt and s not in jobs_stopped:
+                    jobs_stopped.add(s)
+                    s.kill()
+
+def print_split_results():
+    for index, (name, expr) in enumerate(split_props):
+        if index in split_failed:
+            print("%s Assert %d FAILED in step %d: %s" % (smt.timestamp(), index, split_failed[index], name))
+        elif index in split_proven:
+            print("%s Assert %d passed in steps %d to %d: %s" % (smt.timestamp(), index, skip_steps, split_proven[index], name))
+        else:
+            print("%s Assert %d not checked: %s" % (smt.timestamp(), index, name))
+
+def bmc_split():
+    split_properties()
+    for index, (name, expr) in enumerate(split_props):
+        print("%s Assert %d: %s" % (smt.timestamp(), index, name))
+
+    for step in range(0, min(skip_steps, num_steps)):
+        if assume_skipped is not None and step >= assume_skipped:
+            print("%s Skipping step %d (and assuming pass).." % (smt.timestamp(), step))
+        else:
+            print("%s Skipping step %d.." % (smt.timestamp(), step))
+
+    sessions = [smt] if pool is None else pool.sessions
+    props = [(index, expr) for index, (name, expr) in enumerate(split_props)]
+    threads = [threading.Thread(target=profiled(split_worker), args=(s, props[i::len(sessions)])) for i, s in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if split_error is not None:
+        raise split_error
+
+    print_split_results()
+    return len(split_failed) == 0
+
+
+# --prove: the induction loop runs in a second solver session while the main
+# thread runs BMC. bmc_depth and induction_depth are the shared counters:
+# steps 0..bmc_depth-1 passed BMC, and induction succeeded for paths of
+# induction_depth steps.
+def prove_induction(smt):
+    try:
+        induction(smt)
+    except smtabort as e:
+        if not prove_stop:
+            print("%s Induction stopped: %s" % (smt.timestamp(), e))
+
+
+try:
+    if tempind:
+        retstatus = induction(smt)
+
+    elif prove:
+        induction_thread = threading.Thread(target=profiled(prove_induction), args=(ind,))
+        induction_thread.start()
+
+        retstatus = bmc(smt)
+        induction_thread.join()
+
+        if retstatus:
+            if induction_depth is None:
+                print("%s No proof found: BMC passed %d steps, induction did not succeed." % (smt.timestamp(), bmc_depth))
+                retstatus = None
+            elif bmc_depth < max(induction_depth, 1):
+                print("%s No proof found: induction over %d steps succeeded, BMC only covered %d steps." % (smt.timestamp(), induction_depth, bmc_depth))
+                retstatus = None
+            else:
+                print("%s Induction over %d steps and BMC for steps 0 to %d prove the asserts." % (smt.timestamp(), induction_depth, bmc_depth-1))
+
+    elif split_asserts:
+        retstatus = bmc_split()
+
+    elif jobs > 1:
+        retstatus = bmc_jobs()
+
+    else:
+        retstatus = bmc(smt)
+
+except smtabort as e:
+    print("%s %s" % (smt.timestamp(), e))
+    if proven_steps is not None:
+        print("%s Asserts hold in steps %d to %d." % (smt.timestamp(), proven_steps[0], proven_steps[1]))
+    if split_asserts:
+        print_split_results()
+    if ind is not None:
+        stop_induction()
+        induction_thread.join()
+    solver_aborted(None)
+
+
+try:
+    for s in [smt] if pool is None else pool.sessions:
+        if s in jobs_stopped or (s is ind and prove_stop):
+            continue
+        s.write("(exit)")
+        s.wait()
+except smtabort as e:
+    solver_aborted(e)
+
+if len(smt.solver_names) > 1:
+    print("%s Portfolio wins: %s" % (smt.timestamp(), ", ".join(["%s %d" % it for it in smt.solver_stats()])))
 
+if so.debug_print:
+    print("%s Wrote %d bytes in %d statements to the solver using %d flushes." % (smt.timestamp(), smt.bytes_written, smt.num_statements, smt.num_flushes))
 
-smt.write("(exit)")
-smt.wait()
+if retstatus is None:
+    print("%s Status: UNKNOWN" % smt.timestamp())
+    sys.exit(2)
 
 print("%s Status: %s" % (smt.timestamp(), "PASSED" if retstatus else "FAILED (!)"))
 sys.exit(0 if retstatus else 1)
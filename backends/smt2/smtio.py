@@ -17,36 +17,651 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import io
+import os
 import sys
+import re
+import mmap
+import shlex
+import socket
+import struct
+import gzip
+import lzma
+import zlib
+import json
+import pickle
+import hashlib
+import tempfile
+import resource
+import threading
+import asyncio
 import subprocess
+import signal
+from array import array
+from collections import deque
+from collections.abc import Set, Mapping
+from contextlib import contextmanager
 from select import select
 from time import time
 
+# tokens: "(" and ")" in group 1, |quoted symbols|, "string literals" and plain atoms in group 2
+parse_regex = re.compile(r'([()])|(\|[^|]*\||"(?:[^"]|"")*"|[^\s()|"]+)')
+
+# characters that change the bracket/quote state of the response scanner
+scan_regex = re.compile(rb'[()|"\n]')
+scan_nonspace_regex = re.compile(rb'\S')
+
+# "; yosys-smt2-<kind> <fields..>" metadata comments
+info_regex = re.compile(r'; yosys-smt2-(\S+)(.*)')
+load_info_regex = re.compile(rb'^; yosys-smt2-(\S+)([^\n]*)', re.M)
+
+# module boundaries and instantiations, for loading only the part of the hierarchy below -m
+load_hier_regex = re.compile(rb'^; yosys-smt2-(?:module (\S+)|cell (\S+))', re.M)
+load_section_regex = re.compile(rb'^; (?:yosys-smt2-module (\S+)|yosys-smt2-topmod |end of yosys output)', re.M)
+
+# blank lines and lines that only hold a comment
+load_comment_regex = re.compile(rb'^[ \t\r]*(?:;[^\n]*)?\n', re.M)
+
+# bitvector literal prefix: (radix, bits per digit)
+bv_formats = { "#b": (2, 1), "#x": (16, 4) }
+
+# bump when the pickled layout of smtmodinfo / smthierindex changes
+smtmodinfo_version = 4
+
+# bits in smtmodinfo.netkinds
+net_kinds = { "input": 1, "output": 2, "register": 4, "wire": 8 }
+
+class smtnetview(Set):
+    __slots__ = ("info", "kind")
+
+    def __init__(self, info, kind):
+        self.info = info
+        self.kind = kind
+
+    def __contains__(self, name):
+        idx = self.info.netindex.get(name)
+        return idx is not None and (self.info.netkinds[idx] & self.kind) != 0
+
+    def __iter__(self):
+        kind = self.kind
+        for name, k in zip(self.info.netindex, self.info.netkinds):
+            if k & kind:
+                yield name
+
+    def __len__(self):
+        kind = self.kind
+        return sum(1 for k in self.info.netkinds if k & kind)
+
+class smtwidthview(Mapping):
+    __slots__ = ("info",)
+
+    def __init__(self, info):
+        self.info = info
+
+    def __getitem__(self, name):
+        return self.info.netwidths[self.info.netindex[name]]
+
+    def __iter__(self):
+        return iter(self.info.netindex)
+
+    def __len__(self):
+        return len(self.info.netindex)
+
 class smtmodinfo:
+    __slots__ = ("netindex", "netkinds", "netwidths", "memories", "cells", "asserts", "anyconsts")
+
     def __init__(self):
-        self.inputs = set()
-        self.outputs = set()
-        self.registers = set()
+        self.netindex = dict()
+        self.netkinds = array("B")
+        self.netwidths = array("I")
         self.memories = dict()
-        self.wires = set()
-        self.wsize = dict()
         self.cells = dict()
         self.asserts = dict()
         self.anyconsts = dict()
 
-class smtio:
+    def add_net(self, name, kind, width):
+        idx = self.netindex.get(name)
+        if idx is None:
+            self.netindex[sys.intern(name)] = len(self.netkinds)
+            self.netkinds.append(kind)
+            self.netwidths.append(width)
+        else:
+            self.netkinds[idx] |= kind
+            self.netwidths[idx] = width
+
+    @property
+    def inputs(self):
+        return smtnetview(self, net_kinds["input"])
+
+    @property
+    def outputs(self):
+        return smtnetview(self, net_kinds["output"])
+
+    @property
+    def registers(self):
+        return smtnetview(self, net_kinds["register"])
+
+    @property
+    def wires(self):
+        return smtnetview(self, net_kinds["wire"])
+
+    @property
+    def wsize(self):
+        return smtwidthview(self)
+
+class smthierindex:
+    def __init__(self, modinfo, top):
+        # path tuple -> (net id, width, scope)
+        self.netmap = dict()
+
+        # path tuple -> (mem info, scope)
+        self.memmap = dict()
+
+        # (cell path tuple, assert function) -> (assert info, scope)
+        self.assertmap = dict()
+
+        # (cell path tuple, anyconst function) -> (anyconst info, scope)
+        self.anyconstmap = dict()
+
+        self.regs = list()
+        self.worker(modinfo, top, (), ("", ""))
+
+    def worker(self, modinfo, mod, cursor, hier):
+        assert mod in modinfo
+        info = modinfo[mod]
+
+        # scope: (module, expr prefix, expr suffix), shared by all nets of one instance
+        scope = (mod,) + hier
+
+        for netname in sorted(info.netindex):
+            idx = info.netindex[netname]
+            path = cursor + (netname,)
+            self.netmap[path] = (len(self.netmap), info.netwidths[idx], scope)
+            if info.netkinds[idx] & net_kinds["register"]:
+                self.regs.append(path)
+
+        for memname in sorted(info.memories.keys()):
+            self.memmap[cursor + (memname,)] = (info.memories[memname], scope)
+
+        for assertfun, assertinfo in sorted(info.asserts.items()):
+            self.assertmap[(cursor, assertfun)] = (assertinfo, scope)
+
+        for fun, anyconstinfo in sorted(info.anyconsts.items()):
+            self.anyconstmap[(cursor, fun)] = (anyconstinfo, scope)
+
+        for cellname, celltype in sorted(info.cells.items()):
+            self.worker(modinfo, celltype, cursor + (cellname,), ("(|%s_h %s| %s" % (mod, cellname, hier[0]), hier[1] + ")"))
+
+def file_sha256(filename, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h
+
+
+# The directory size is counted once when the cache is opened and then kept up
+# to date by put(). Only when it exceeds max_size is the directory scanned
+# again, and entries are evicted down to 3/4 of it so that does not happen on
+# every put. Other processes writing to the same directory are only noticed
+# by that scan.
+# Cache entries are pickles. Loading one may only create the classes the
+# cache itself stores, so a planted file can not run code. It can still change
+# the cached results, the directory must only be writable by trusted users.
+class smtunpickler(pickle.Unpickler):
+    safe_globals = {("array", "array"), ("array", "_array_reconstructor"),
+            (__name__, "smtmodinfo"), (__name__, "smthierindex")}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.safe_globals:
+            raise pickle.UnpicklingError("cache entry refers to %s.%s" % (module, name))
+        return super().find_class(module, name)
+
+class smtcache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.total_size = sum(size for mtime, size, filename in self.entries())
+
+    def get(self, key):
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename)
+        except OSError:
+            return None
+        try:
+            return smtunpickler(io.BytesIO(zlib.decompress(data))).load()
+        except (pickle.UnpicklingError, zlib.error):
+            return None
+
+    def put(self, key, obj):
+        filename = os.path.join(self.path, key)
+        data = zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 1)
+        fd, tmpname = tempfile.mkstemp(prefix=".tmp", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            self.total_size -= os.stat(filename).st_size
+        except OSError:
+            pass
+        os.replace(tmpname, filename)
+        self.total_size += len(data)
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        entries = list()
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        self.total_size = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if self.total_size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.total_size -= size
+
+class smtreader:
+    def __init__(self):
+        self.buf = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.pos = 0
+        self.depth = 0
+        self.quote = None
+        self.started = False
+
+    def feed(self, data):
+        self.buf += data
+
+    def scan(self):
+        buf = self.buf
+        pos = self.pos
+
+        while True:
+            if self.quote is not None:
+                pos = buf.find(self.quote, pos)
+                if pos < 0:
+                    self.pos = len(buf)
+                    return None
+                self.quote = None
+                pos += 1
+                continue
+
+            if not self.started:
+                m = scan_nonspace_regex.search(buf, pos)
+                if m is None:
+                    self.pos = len(buf)
+                    return None
+                self.started = True
+                pos = m.start()
+
+            m = scan_regex.search(buf, pos)
+            if m is None:
+                self.pos = len(buf)
+                return None
+
+            pos = m.end()
+            c = buf[m.start()]
+
+            if c == 0x28: # (
+                self.depth += 1
+            elif c == 0x29: # )
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+            elif c == 0x0a: # newline
+                if self.depth == 0:
+                    return pos
+            else: # | or "
+                self.quote = bytes([c])
+
+    def response(self):
+        end = self.scan()
+        if end is None:
+            return None
+        stmt = self.buf[:end].decode("ascii").strip()
+        del self.buf[:end]
+        self.reset()
+        return stmt
+
+
+solver_commands = {
+    "yices": ['yices-smt2', '--incremental'],
+    "z3": ['z3', '-smt2', '-in'],
+    "cvc4": ['cvc4', '--incremental', '--lang', 'smt2'],
+    "mathsat": ['mathsat'],
+}
+
+# Nestable timing spans, written in Chrome trace-event format
+# (chrome://tracing, Perfetto) when --profile-trace is given.
+class smtprofile:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.start_time = time()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time()
+        try:
+            yield
+        finally:
+            event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": int((start - self.start_time) * 1e6), "dur": int((time() - start) * 1e6)}
+            if args:
+                event["args"] = args
+            self.events.append(event)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+class smtabort(Exception):
+    pass
+
+
+def solver_command(name):
+    if name in solver_commands:
+        return solver_commands[name]
+    return shlex.split(name)
+
+def solver_limits(mem_limit):
+    if mem_limit is None:
+        return None
+    def set_limits():
+        resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+    return set_limits
+
+# Solver transports: a local subprocess, or a connection to yosys-smtserver
+# over a Unix socket or TCP. The first line sent on a connection is the
+# solver name, the server answers it with one line before everything else
+# is the plain SMT-LIB2 stream.
+class smtprocess:
+    def __init__(self, name, mem_limit=None):
+        self.p = subprocess.Popen(solver_command(name), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                preexec_fn=solver_limits(mem_limit))
+        self.rfd = self.p.stdout.fileno()
+        self.wfd = self.p.stdin.fileno()
+
+    def write(self, data):
+        self.p.stdin.write(data)
+        self.p.stdin.flush()
+
+    def close(self):
+        self.p.stdin.close()
+
+    def kill(self):
+        self.p.kill()
+
+    def wait(self):
+        self.p.wait()
+
+
+class smtsocket:
+    def __init__(self, name, address):
+        try:
+            if address.startswith("unix:"):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(address[len("unix:"):])
+            else:
+                host, port = address.rsplit(":", 1)
+                self.sock = socket.create_connection((host, int(port)))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            server_error(name, address, e.strerror or str(e))
+        self.p = None
+        self.rfd = self.sock.fileno()
+        self.wfd = self.sock.fileno()
+        self.sock.sendall(bytes(name + "\n", "ascii"))
+
+        # byte by byte, everything after the reply line is solver output
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = self.sock.recv(1)
+            if len(data) == 0:
+                break
+            reply += data
+        check_server_reply(name, address, reply)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.sock.fileno() >= 0:
+            self.sock.shutdown(socket.SHUT_WR)
+
+    def kill(self):
+        # reset instead of a normal close, so the server stops the solver
+        # right away instead of letting it finish the current query. the
+        # shutdown wakes a thread blocked in select() on this socket, closing
+        # the fd alone does not.
+        if self.sock.fileno() >= 0:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.sock.close()
+
+    def wait(self):
+        if self.sock.fileno() >= 0:
+            while len(self.sock.recv(1 << 16)) != 0:
+                pass
+            self.sock.close()
+
+
+# "<host>:<port>" or "unix:<path>" after the last "@" of a solver name
+transport_regex = re.compile(r'^(unix:.+|[^:@/]+:[0-9]+)$')
+
+def solver_address(name):
+    solver, _, address = name.rpartition("@")
+    if solver != "" and transport_regex.match(address):
+        return solver, address
+    return name, None
+
+# the reply to the name line is "ok" or the (error ...) the server refused
+# the solver with
+def check_server_reply(name, address, reply):
+    reply = reply.decode("ascii", errors="replace").strip()
+    if reply != "ok":
+        server_error(name, address, reply if reply != "" else "connection closed by the server")
+
+def server_error(name, address, reason):
+    print("SMT Solver Error: %s@%s: %s" % (name, address, reason), file=sys.stderr)
+    sys.exit(1)
+
+def solver_transport(name, mem_limit=None):
+    solver, address = solver_address(name)
+    if address is not None:
+        return smtsocket(solver, address)
+    return smtprocess(name, mem_limit)
+
+
+# what smtsolver and asyncsmtsolver share: the reply reader and the
+# portfolio bookkeeping
+class smtsolverbase:
+    def __init__(self, name):
+        self.name = name
+        self.reader = smtreader()
+
+        # number of (check-sat) answers this solver still owes us
+        self.pending = 0
+        self.wins = 0
+
+    # a solver that was killed (maybe from another thread) or lost its
+    # connection shows up as OSError on its pipe or socket
+    def terminated(self):
+        return smtabort("SMT Solver %s terminated unexpectedly: %s" % (self.name, self.reader.buf.decode("ascii", errors="replace")))
+
+
+class smtsolver(smtsolverbase):
+    def __init__(self, name, mem_limit=None):
+        super().__init__(name)
+        self.transport = solver_transport(name, mem_limit)
+        self.p = self.transport.p
+
+        # portfolio: data this solver did not take yet, see send_nowait()
+        self.backlog = deque()
+
+    def fileno(self):
+        return self.transport.rfd
+
+    # returns False when the deadline passed before all data was written
+    def send(self, data, drain=False, deadline=None):
+        if len(self.backlog) != 0:
+            data = b"".join(self.backlog) + data
+            self.backlog.clear()
+
+        try:
+            if drain or deadline is not None:
+                return self.send_drain(data, deadline)
+            self.transport.write(data)
+            return True
+        except OSError:
+            raise self.terminated() from None
+
+    # replies to queued queries are still on their way: keep reading them
+    # while writing so neither side blocks on a full pipe
+    def send_drain(self, data, deadline=None):
+        fd = self.transport.wfd
+        view = memoryview(data)
+        os.set_blocking(fd, False)
+        try:
+            while len(view) != 0:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time()
+                    if timeout <= 0:
+                        return False
+                ready = select([self], [fd], [], timeout)
+                if len(ready[0]) != 0:
+                    self.receive(1 << 16)
+                if len(ready[1]) != 0:
+                    try:
+                        view = view[os.write(fd, view[:1 << 16]):]
+                    except BlockingIOError:
+                        pass
+        finally:
+            os.set_blocking(fd, True)
+        return True
+
+    # A portfolio solver that is still busy with an old check-sat does not read
+    # its input. Keep what it can not take right now instead of blocking the
+    # other solvers on it, push() sends more whenever its pipe has room.
+    def send_nowait(self, data):
+        self.backlog.append(data)
+        self.push()
+
+    def push(self):
+        fd = self.transport.wfd
+        try:
+            os.set_blocking(fd, False)
+            try:
+                while len(self.backlog) != 0:
+                    data = self.backlog[0]
+                    count = os.write(fd, data)
+                    if count < len(data):
+                        self.backlog[0] = data[count:]
+                        break
+                    self.backlog.popleft()
+            except BlockingIOError:
+                pass
+            finally:
+                os.set_blocking(fd, True)
+        except OSError:
+            raise self.terminated() from None
+
+    def receive(self, size):
+        try:
+            data = os.read(self.fileno(), size)
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            raise self.terminated()
+        self.reader.feed(data)
+
+    def wait(self):
+        if self.pending > 0:
+            self.transport.kill()
+        elif len(self.backlog) != 0:
+            self.send(b"")
+        self.transport.close()
+        self.transport.wait()
+
+    def kill(self):
+        self.transport.kill()
+        self.transport.wait()
+
+
+# Reply to a query sent with one of the smtio.*_future() methods. Replies are
+# matched to futures in the order the queries were sent, result() blocks
+# until this one (and all queued before it) has been read.
+class smtfuture:
+    def __init__(self, smt, decode=None, sat=False):
+        self.smt = smt
+        self.decode = decode
+        self.sat = sat
+        self.done = False
+        self.value = None
+
+    def set(self, stmt):
+        self.value = stmt if self.decode is None else self.decode(stmt)
+        self.done = True
+
+    def result(self):
+        if not self.done:
+            self.smt.resolve(self)
+        return self.value
+
+
+class smtiobase:
+    lazy_start = True
+
     def __init__(self, solver=None, debug_print=None, debug_file=None, timeinfo=None, opts=None):
         if opts is not None:
             self.solver = opts.solver
             self.debug_print = opts.debug_print
             self.debug_file = opts.debug_file
             self.timeinfo = opts.timeinfo
+            self.cache_dir = opts.cache_dir
+            self.cache_results = opts.cache_results
+            self.cache_size = opts.cache_size
+            self.timeout = opts.timeout
+            self.query_timeout = opts.query_timeout
+            self.mem_limit = opts.mem_limit
+            self.stats_file = opts.stats_file
+            self.profile = opts.profile
 
         else:
             self.solver = "z3"
             self.debug_print = False
             self.debug_file = None
             self.timeinfo = True
+            self.cache_dir = None
+            self.cache_results = False
+            self.cache_size = 256 << 20
+            self.timeout = None
+            self.query_timeout = None
+            self.mem_limit = None
+            self.stats_file = None
+            self.profile = smtprofile()
 
         if solver is not None:
             self.solver = solver
@@ -60,25 +675,73 @@ class smtio:
         if timeinfo is not None:
             self.timeinfo = timeinfo
 
-        if self.solver == "yices":
-            popen_vargs = ['yices-smt2', '--incremental']
+        if self.solver.startswith("portfolio:"):
+            self.solver_names = self.solver[len("portfolio:"):].split(",")
+        else:
+            self.solver_names = [self.solver]
 
-        if self.solver == "z3":
-            popen_vargs = ['z3', '-smt2', '-in']
+        self.start_time = time()
+        self.deadline = None
+        if self.timeout is not None:
+            self.deadline = self.start_time + self.timeout
 
-        if self.solver == "cvc4":
-            popen_vargs = ['cvc4', '--incremental', '--lang', 'smt2']
+        self.read_chunk = 1 << 20
 
-        if self.solver == "mathsat":
-            popen_vargs = ['mathsat']
+        self.write_buf = []
+        self.write_buf_size = 0
+        self.write_buf_limit = 1 << 20
+        self.load_chunk = 1 << 20
+        self.bytes_written = 0
+        self.num_flushes = 0
+        self.num_statements = 0
 
-        self.p = subprocess.Popen(popen_vargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        self.start_time = time()
+        self.futures = deque()
+
+        # set by the caller, copied into each --stats-json record
+        self.stats_step = None
+        self.stats_mode = None
+        self.stats_bytes = 0
+        self.stats_statements = 0
 
         self.modinfo = dict()
+        self.hier_index = dict()
         self.curmod = None
         self.topmod = None
 
+        self.cache = None
+        if self.cache_dir is not None:
+            self.cache = smtcache(self.cache_dir, self.cache_size)
+
+        # with a cache directory, check-sat and get-value answers are looked up
+        # by a hash of everything sent so far. the solver is only started on the
+        # first miss and is then fed the transcript recorded up to that point.
+        self.stream_hash = None
+        self.transcript = None
+        self.transcript_responses = 0
+        self.result_key = None
+        self.result_entry = None
+        self.result_dirty = False
+
+        # set by kill(), a cached session must not start its solver after that
+        self.killed = False
+
+        if self.cache is not None and self.cache_results and len(self.solver_names) == 1 and self.lazy_start:
+            self.stream_hash = hashlib.sha256(bytes(self.solver + "\n", "ascii"))
+            self.transcript = []
+            self.solvers = []
+            self.winner = None
+            self.p = None
+        else:
+            self.start_solvers()
+
+    def start_solvers(self):
+        if self.killed:
+            raise smtabort("SMT Solver %s was stopped." % self.solver)
+        self.solvers = [smtsolver(name, self.mem_limit) for name in self.solver_names]
+        self.dropped = []
+        self.winner = self.solvers[0]
+        self.p = self.winner.p
+
     def setup(self, logic="ALL", info=None):
         self.write("(set-logic %s)" % logic)
         if info is not None:
@@ -91,240 +754,605 @@ class smtio:
         return "## %6d %3d:%02d:%02d " % (secs, secs // (60*60), (secs // 60) % 60, secs % 60)
 
     def write(self, stmt):
+        if self.buffer_stmt(stmt):
+            self.flush()
+
+    def write_raw(self, data, num_statements=1):
+        if self.buffer_raw(data, num_statements):
+            self.flush()
+
+    def buffer_stmt(self, stmt):
         stmt = stmt.strip()
         if self.debug_print:
             print("> %s" % stmt)
-        if self.debug_file:
-            print(stmt, file=self.debug_file)
+        self.write_buf.append(bytes(stmt + "\n", "ascii"))
+        self.write_buf_size += len(stmt) + 1
+        self.num_statements += 1
+        return self.write_buf_size >= self.write_buf_limit or stmt.startswith(("(push", "(pop", "(exit"))
+
+    def buffer_raw(self, data, num_statements=1):
+        if self.debug_print:
+            for line in data.decode("ascii").splitlines():
+                print("> %s" % line)
+        self.write_buf.append(data)
+        self.write_buf_size += len(data)
+        self.num_statements += num_statements
+        return self.write_buf_size >= self.write_buf_limit
+
+    def take_write_buf(self, tail=""):
+        if len(self.write_buf) == 0 and tail == "":
+            return None
+        data = b"".join(self.write_buf)
+        self.write_buf = []
+        self.write_buf_size = 0
+        if self.debug_file and len(data) != 0:
+            self.debug_file.write(data.decode("ascii"))
             self.debug_file.flush()
-        self.p.stdin.write(bytes(stmt + "\n", "ascii"))
-        self.p.stdin.flush()
+        data += bytes(tail, "ascii")
+        self.bytes_written += len(data)
+        self.num_flushes += 1
+        return data
+
+    def flush(self, tail="", solvers=None):
+        data = self.take_write_buf(tail)
+        if data is not None:
+            if self.stream_hash is not None:
+                self.stream_hash.update(data)
+                if self.transcript is not None:
+                    self.transcript.append(data)
+            for solver in list(self.solvers) if solvers is None else solvers:
+                if len(self.solvers) > 1:
+                    try:
+                        solver.send_nowait(data)
+                    except smtabort as e:
+                        if not self.drop_solver(solver, e):
+                            raise
+                elif not solver.send(data, len(self.futures) != 0, self.deadline):
+                    raise self.deadline_abort(self.deadline)
+
+    def replay_transcript(self):
+        self.start_solvers()
+        transcript, self.transcript = self.transcript, None
+        for i in range(len(transcript)):
+            data, transcript[i] = transcript[i], None
+            if not self.winner.send(data, self.transcript_responses != 0, self.deadline):
+                raise self.deadline_abort(self.deadline)
+        for i in range(self.transcript_responses):
+            self.read_response(self.winner)
+
+    def cached_check_sat(self):
+        self.save_result()
+        self.result_key = "result-" + self.stream_hash.hexdigest()
+        self.result_entry = None
+
+        if self.transcript is None:
+            return None
+
+        entry = self.cache.get(self.result_key)
+        if entry is not None:
+            self.result_entry = entry
+            self.transcript_responses += 1
+            return entry["result"]
+
+        self.replay_transcript()
+        return None
+
+    def cached_query(self):
+        key = self.stream_hash.hexdigest()
+        if self.result_entry is not None and key in self.result_entry["replies"]:
+            self.transcript_responses += 1
+            return self.result_entry["replies"][key]
+        self.replay_transcript()
+        return None
+
+    def save_result(self, result=None, reply=None):
+        if result is not None:
+            self.result_entry = {"result": result, "replies": dict()}
+            self.result_dirty = True
+        if reply is not None and self.result_entry is not None:
+            self.result_entry["replies"][self.stream_hash.hexdigest()] = reply
+            self.result_dirty = True
+        if result is None and reply is None and self.result_dirty:
+            self.cache.put(self.result_key, self.result_entry)
+            self.result_dirty = False
+
+    def load_design(self, filename, topmod=None, mirrors=()):
+        with self.profile.span("load design", file=filename):
+            for _ in self.load_design_steps(filename, topmod, mirrors):
+                pass
+
+    def load_design_steps(self, filename, topmod=None, mirrors=()):
+        cache_key = None
+        parse_info = True
+        self.load_mirrors = mirrors
+        self.load_modules = None
+        self.load_skip = False
+
+        if self.cache is not None:
+            h = file_sha256(filename, self.load_chunk)
+            if topmod is not None:
+                h.update(b"\0" + bytes(topmod, "ascii"))
+            cache_key = "info%d-%s" % (smtmodinfo_version, h.hexdigest())
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.modinfo, self.topmod, self.hier_index = cached
+                parse_info = False
+                if topmod is not None:
+                    self.load_modules = set(self.modinfo.keys())
+
+        if topmod is not None and self.load_modules is None:
+            self.load_modules = self.reachable_modules(filename, topmod)
+
+        for block in self.design_blocks(filename):
+            try:
+                self.load_block(block, parse_info)
+            finally:
+                # an exported view keeps the mapping from being closed
+                if isinstance(block, memoryview):
+                    block.release()
+            yield
+
+        for smt in mirrors:
+            smt.modinfo = self.modinfo
+            smt.topmod = self.topmod
+            smt.hier_index = self.hier_index
+
+        if cache_key is not None and parse_info:
+            if topmod is None:
+                topmod = self.topmod
+            if topmod in self.modinfo:
+                self.hierindex(topmod)
+            self.cache.put(cache_key, (self.modinfo, self.topmod, self.hier_index))
+
+    def reachable_modules(self, filename, topmod):
+        cells = dict()
+        mod = None
+
+        for block in self.design_blocks(filename):
+            for m in load_hier_regex.finditer(block):
+                if m.group(1) is not None:
+                    mod = m.group(1).decode("ascii")
+                    cells[mod] = set()
+                else:
+                    cells[mod].add(m.group(2).decode("ascii"))
+            if isinstance(block, memoryview):
+                block.release()
+
+        modules = set()
+        queue = [topmod]
+        while len(queue) != 0:
+            mod = queue.pop()
+            if mod in modules or mod not in cells:
+                continue
+            modules.add(mod)
+            queue.extend(cells[mod])
+        return modules
+
+    def design_blocks(self, filename):
+        opener = None
+
+        if filename.endswith(".gz"):
+            opener = gzip.open
+
+        if filename.endswith(".xz"):
+            opener = lzma.open
+
+        if filename.endswith(".zst"):
+            try:
+                from compression import zstd
+                opener = zstd.open
+            except ImportError:
+                print("Reading zstd compressed input is not supported by this Python version: %s" % filename, file=sys.stderr)
+                sys.exit(1)
 
-    def info(self, stmt):
-        if not stmt.startswith("; yosys-smt2-"):
+        if opener is not None:
+            with opener(filename, "rb") as f:
+                tail = b""
+                while True:
+                    block = f.read(self.load_chunk)
+                    if len(block) == 0:
+                        break
+                    block = tail + block
+                    cut = block.rfind(b"\n") + 1
+                    tail = block[cut:]
+                    if cut != 0:
+                        yield block[:cut]
+                if len(tail) != 0:
+                    yield tail + b"\n"
             return
 
-        fields = stmt.split()
-
-        if fields[1] == "yosys-smt2-module":
-            self.curmod = fields[2]
-            self.modinfo[self.curmod] = smtmodinfo()
-
-        if fields[1] == "yosys-smt2-cell":
-            self.modinfo[self.curmod].cells[fields[3]] = fields[2]
-
-        if fields[1] == "yosys-smt2-topmod":
-            self.topmod = fields[2]
-
-        if fields[1] == "yosys-smt2-input":
-            self.modinfo[self.curmod].inputs.add(fields[2])
-            self.modinfo[self.curmod].wsize[fields[2]] = int(fields[3])
-
-        if fields[1] == "yosys-smt2-output":
-            self.modinfo[self.curmod].outputs.add(fields[2])
-            self.modinfo[self.curmod].wsize[fields[2]] = int(fields[3])
-
-        if fields[1] == "yosys-smt2-register":
-            self.modinfo[self.curmod].registers.add(fields[2])
-            self.modinfo[self.curmod].wsize[fields[2]] = int(fields[3])
-
-        if fields[1] == "yosys-smt2-memory":
-            self.modinfo[self.curmod].memories[fields[2]] = (int(fields[3]), int(fields[4]), int(fields[5]))
-
-        if fields[1] == "yosys-smt2-wire":
-            self.modinfo[self.curmod].wires.add(fields[2])
-            self.modinfo[self.curmod].wsize[fields[2]] = int(fields[3])
-
-        if fields[1] == "yosys-smt2-assert":
-            self.modinfo[self.curmod].asserts[fields[2]] = fields[3]
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                pos = 0
+                while pos < size:
+                    end = min(pos + self.load_chunk, size)
+                    if end < size:
+                        cut = mm.rfind(b"\n", pos, end) + 1
+                        if cut == 0:
+                            cut = mm.find(b"\n", end) + 1
+                        end = size if cut == 0 else cut
+                    if end == size and view[size-1] != 0x0a:
+                        yield bytes(view[pos:end]) + b"\n"
+                    else:
+                        yield view[pos:end]
+                    pos = end
+
+    def load_block(self, block, parse_info=True):
+        if self.load_modules is not None:
+            parts = list()
+            pos = 0
+            for m in load_section_regex.finditer(block):
+                if not self.load_skip:
+                    parts.append(block[pos:m.start()])
+                pos = m.start()
+                self.load_skip = m.group(1) is not None and m.group(1).decode("ascii") not in self.load_modules
+            if not self.load_skip:
+                parts.append(block[pos:])
+            block = b"".join(parts)
+
+        if parse_info:
+            for m in load_info_regex.finditer(block):
+                self.info_fields(m.group(1).decode("ascii"), m.group(2).decode("ascii").split())
+        block = load_comment_regex.sub(b"", block)
+        num_statements = block.count(b"\n")
+        self.write_raw(block, num_statements)
+        for smt in self.load_mirrors:
+            smt.write_raw(block, num_statements)
 
-        if fields[1] == "yosys-smt2-anyconst":
-            self.modinfo[self.curmod].anyconsts[fields[2]] = fields[3]
+    def info(self, stmt):
+        m = info_regex.match(stmt)
+        if m is not None:
+            self.info_fields(m.group(1), m.group(2).split())
+
+    def info_fields(self, kind, fields):
+        if kind in self.info_handlers:
+            self.hier_index.clear()
+            self.info_handlers[kind](self, fields)
+
+    def info_module(self, fields):
+        self.curmod = fields[0]
+        self.modinfo[self.curmod] = smtmodinfo()
+
+    def info_cell(self, fields):
+        self.modinfo[self.curmod].cells[sys.intern(fields[1])] = fields[0]
+
+    def info_topmod(self, fields):
+        self.topmod = fields[0]
+
+    def info_net(self, fields, kind):
+        self.modinfo[self.curmod].add_net(fields[0], net_kinds[kind], int(fields[1]))
+
+    def info_memory(self, fields):
+        self.modinfo[self.curmod].memories[sys.intern(fields[0])] = (int(fields[1]), int(fields[2]), int(fields[3]))
+
+    def info_assert(self, fields):
+        self.modinfo[self.curmod].asserts[fields[0]] = fields[1]
+
+    def info_anyconst(self, fields):
+        self.modinfo[self.curmod].anyconsts[fields[0]] = fields[1]
+
+    info_handlers = {
+        "module": info_module,
+        "cell": info_cell,
+        "topmod": info_topmod,
+        "input": lambda self, fields: self.info_net(fields, "input"),
+        "output": lambda self, fields: self.info_net(fields, "output"),
+        "register": lambda self, fields: self.info_net(fields, "register"),
+        "memory": info_memory,
+        "wire": lambda self, fields: self.info_net(fields, "wire"),
+        "assert": info_assert,
+        "anyconst": info_anyconst,
+    }
+
+    def hierindex(self, top):
+        if top not in self.hier_index:
+            self.hier_index[top] = smthierindex(self.modinfo, top)
+        return self.hier_index[top]
 
     def hiernets(self, top, regs_only=False):
-        def hiernets_worker(nets, mod, cursor):
-            for netname in sorted(self.modinfo[mod].wsize.keys()):
-                if not regs_only or netname in self.modinfo[mod].registers:
-                    nets.append(cursor + [netname])
-            for cellname, celltype in sorted(self.modinfo[mod].cells.items()):
-                hiernets_worker(nets, celltype, cursor + [cellname])
-
-        nets = list()
-        hiernets_worker(nets, top, [])
-        return nets
+        index = self.hierindex(top)
+        return [list(path) for path in (index.regs if regs_only else index.netmap)]
 
     def hiermems(self, top):
-        def hiermems_worker(mems, mod, cursor):
-            for memname in sorted(self.modinfo[mod].memories.keys()):
-                mems.append(cursor + [memname])
-            for cellname, celltype in sorted(self.modinfo[mod].cells.items()):
-                hiermems_worker(mems, celltype, cursor + [cellname])
+        return [list(path) for path in self.hierindex(top).memmap]
 
-        mems = list()
-        hiermems_worker(mems, top, [])
-        return mems
+    def hierasserts(self, top):
+        return [(list(path), assertfun, assertinfo) for (path, assertfun), (assertinfo, scope) in self.hierindex(top).assertmap.items()]
 
     def read(self):
-        stmt = []
-        count_brackets = 0
+        self.flush()
 
+        if len(self.winner.backlog) != 0 and not self.winner.send(b"", deadline=self.deadline):
+            raise self.deadline_abort(self.deadline)
+
+        return self.check_response(self.winner, self.read_response(self.winner))
+
+    # the next reply of this solver, bounded by --timeout
+    def read_response(self, solver):
         while True:
-            line = self.p.stdout.readline().decode("ascii").strip()
-            count_brackets += line.count("(")
-            count_brackets -= line.count(")")
-            stmt.append(line)
-            if self.debug_print:
-                print("< %s" % line)
-            if count_brackets == 0:
-                break
-            if self.p.poll():
-                print("SMT Solver terminated unexpectedly: %s" % "".join(stmt))
-                sys.exit(1)
+            stmt = solver.reader.response()
+            if stmt is not None:
+                return stmt
+            if self.deadline is not None:
+                remaining = self.deadline - time()
+                if remaining <= 0 or len(select([solver], [], [], remaining)[0]) == 0:
+                    raise self.deadline_abort(self.deadline)
+            solver.receive(self.read_chunk)
+
+    def check_response(self, solver, stmt):
+        if self.debug_print:
+            prefix = "" if len(self.solvers) <= 1 else "[%s] " % solver.name
+            for line in stmt.split("\n"):
+                print("< %s%s" % (prefix, line.strip()))
 
-        stmt = "".join(stmt)
         if stmt.startswith("(error"):
+            if "out of memory" in stmt:
+                raise smtabort("SMT Solver %s ran out of memory." % solver.name)
             print("SMT Solver Error: %s" % stmt, file=sys.stderr)
             sys.exit(1)
 
         return stmt
 
+    # portfolio: a member that died or answered with an error is left out as
+    # long as another one can still answer. The winner can only be replaced
+    # while it still owes a check-sat answer, after that the following queries
+    # depend on its state.
+    def drop_solver(self, solver, reason):
+        if solver not in self.solvers:
+            return True
+        if len(self.solvers) == 1 or (solver is self.winner and solver.pending == 0):
+            return False
+        self.solvers.remove(solver)
+        self.dropped.append(solver)
+        solver.kill()
+        if solver is self.winner:
+            self.winner = self.solvers[0]
+        print("%s Portfolio: dropped %s: %s" % (self.timestamp(), solver.name, str(reason).strip()))
+        return True
+
+    def query(self, stmt):
+        if self.stream_hash is not None:
+            self.flush()
+            self.buffer_stmt(stmt)
+            self.flush()
+            if self.transcript is not None:
+                reply = self.cached_query()
+                if reply is not None:
+                    return self.check_response(self.winner, reply)
+            reply = self.read()
+            self.save_result(reply=reply)
+            return reply
+
+        if len(self.solvers) > 1:
+            self.flush()
+        self.buffer_stmt(stmt)
+        self.flush(solvers=[self.winner])
+        return self.read()
+
+    def check_sat_poll(self, answers):
+        for solver in list(self.solvers):
+            while solver.pending > 0:
+                stmt = solver.reader.response()
+                if stmt is None:
+                    break
+                if stmt.startswith("(error") and self.drop_solver(solver, stmt):
+                    break
+                stmt = self.check_response(solver, stmt)
+                solver.pending -= 1
+                if solver.pending == 0:
+                    answers[solver] = stmt
+                    if stmt in ("sat", "unsat"):
+                        self.winner = solver
+                        solver.wins += 1
+                        return stmt
+
+        if all(solver in answers for solver in self.solvers):
+            return answers[self.solvers[0]]
+
+        return None
+
     def check_sat(self):
         if self.debug_print:
             print("> (check-sat)")
+        self.flush("(check-sat)\n")
+        self.num_statements += 1
+
+        result = None
+        start = time()
+        if self.stream_hash is not None:
+            result = self.cached_check_sat()
+
+        for solver in self.solvers:
+            solver.pending += 1
+
         if self.debug_file:
             print("; running check-sat..", file=self.debug_file)
             self.debug_file.flush()
 
-        self.p.stdin.write(bytes("(check-sat)\n", "ascii"))
-        self.p.stdin.flush()
+        answers = dict()
+        if result is None:
+            with self.profile.span("solve"):
+                result = self.wait_response(lambda: self.check_sat_poll(answers))
+            if self.stream_hash is not None:
+                self.save_result(result=result)
 
-        if self.timeinfo:
-            i = 0
-            s = "/-\|"
+        if self.stats_file is not None:
+            self.log_stats("check-sat", time() - start, result, len(result), 0)
 
-            count = 0
-            num_bs = 0
-            while select([self.p.stdout], [], [], 0.1) == ([], [], []):
-                count += 1
+        if self.debug_file:
+            print("(set-info :status %s)" % result, file=self.debug_file)
+            print("(check-sat)", file=self.debug_file)
+            self.debug_file.flush()
+        return result
 
-                if count < 25:
-                    continue
+    def log_stats(self, query, solve_time, result, response_size, parse_time):
+        record = {
+            "query": query,
+            "step": self.stats_step,
+            "mode": self.stats_mode,
+            "solver": self.winner.name if self.transcript is None else "cache",
+            "bytes": self.bytes_written - self.stats_bytes,
+            "statements": self.num_statements - self.stats_statements,
+            "solve_time": round(solve_time, 6),
+            "result": result,
+            "response_size": response_size,
+            "parse_time": round(parse_time, 6),
+        }
+        self.stats_bytes = self.bytes_written
+        self.stats_statements = self.num_statements
+        self.stats_file.write(json.dumps(record) + "\n")
+
+    def query_deadline(self):
+        deadline = self.deadline
+        if self.query_timeout is not None:
+            deadline = time() + self.query_timeout if deadline is None else min(deadline, time() + self.query_timeout)
+        return deadline
+
+    def deadline_abort(self, deadline):
+        if deadline == self.deadline:
+            return smtabort("Time limit of %d seconds reached." % self.timeout)
+        return smtabort("Query time limit of %d seconds reached." % self.query_timeout)
+
+    def wait_response(self, poll):
+        i = 0
+        s = "/-\|"
+
+        count = 0
+        num_bs = 0
+
+        deadline = self.query_deadline()
 
-                if count % 10 == 0 or count == 25:
-                    secs = count // 10
+        while True:
+            result = poll()
+            if result is not None:
+                break
 
-                    if secs < 60:
-                        m = "(%d seconds)" % secs
-                    elif secs < 60*60:
-                        m = "(%d seconds -- %d:%02d)" % (secs, secs // 60, secs % 60)
-                    else:
-                        m = "(%d seconds -- %d:%02d:%02d)" % (secs, secs // (60*60), (secs // 60) % 60, secs % 60)
+            timeout = 0.1 if self.timeinfo else None
+            if deadline is not None:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    if num_bs != 0:
+                        print("\b \b" * num_bs, end="", file=sys.stderr)
+                        sys.stderr.flush()
+                    raise self.deadline_abort(deadline)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            writing = [solver for solver in self.solvers if len(solver.backlog) != 0]
+            try:
+                ready, writable, _ = select(self.solvers, [solver.transport.wfd for solver in writing], [], timeout)
+            except OSError:
+                raise smtabort("SMT Solver terminated unexpectedly.") from None
+            for solver in writing:
+                if solver.transport.wfd in writable:
+                    try:
+                        solver.push()
+                    except smtabort as e:
+                        if not self.drop_solver(solver, e):
+                            raise
+            for solver in ready:
+                try:
+                    solver.receive(self.read_chunk)
+                except smtabort as e:
+                    if not self.drop_solver(solver, e):
+                        raise
+
+            if len(ready) != 0 or len(writable) != 0:
+                continue
+
+            count += 1
+
+            if count < 25:
+                continue
+
+            if count % 10 == 0 or count == 25:
+                secs = count // 10
+
+                if secs < 60:
+                    m = "(%d seconds)" % secs
+                elif secs < 60*60:
+                    m = "(%d seconds -- %d:%02d)" % (secs, secs // 60, secs % 60)
+                else:
+                    m = "(%d seconds -- %d:%02d:%02d)" % (secs, secs // (60*60), (secs // 60) % 60, secs % 60)
 
-                    print("%s %s %c" % ("\b \b" * num_bs, m, s[i]), end="", file=sys.stderr)
-                    num_bs = len(m) + 3
+                print("%s %s %c" % ("\b \b" * num_bs, m, s[i]), end="", file=sys.stderr)
+                num_bs = len(m) + 3
 
-                else:
-                    print("\b" + s[i], end="", file=sys.stderr)
+            else:
+                print("\b" + s[i], end="", file=sys.stderr)
 
-                sys.stderr.flush()
-                i = (i + 1) % len(s)
+            sys.stderr.flush()
+            i = (i + 1) % len(s)
 
-            if num_bs != 0:
-                print("\b \b" * num_bs, end="", file=sys.stderr)
-                sys.stderr.flush()
+        if num_bs != 0:
+            print("\b \b" * num_bs, end="", file=sys.stderr)
+            sys.stderr.flush()
 
-        result = self.read()
-        if self.debug_file:
-            print("(set-info :status %s)" % result, file=self.debug_file)
-            print("(check-sat)", file=self.debug_file)
-            self.debug_file.flush()
         return result
 
+    def solver_stats(self):
+        return [(solver.name, solver.wins) for solver in self.solvers + self.dropped]
+
     def parse(self, stmt):
-        def worker(stmt):
-            if stmt[0] == '(':
+        stack = [[]]
+        for paren, atom in parse_regex.findall(stmt):
+            if paren == "(":
                 expr = []
-                cursor = 1
-                while stmt[cursor] != ')':
-                    el, le = worker(stmt[cursor:])
-                    expr.append(el)
-                    cursor += le
-                return expr, cursor+1
-
-            if stmt[0] == '|':
-                expr = "|"
-                cursor = 1
-                while stmt[cursor] != '|':
-                    expr += stmt[cursor]
-                    cursor += 1
-                expr += "|"
-                return expr, cursor+1
-
-            if stmt[0] in [" ", "\t", "\r", "\n"]:
-                el, le = worker(stmt[1:])
-                return el, le+1
-
-            expr = ""
-            cursor = 0
-            while stmt[cursor] not in ["(", ")", "|", " ", "\t", "\r", "\n"]:
-                expr += stmt[cursor]
-                cursor += 1
-            return expr, cursor
-        return worker(stmt)[0]
+                stack[-1].append(expr)
+                stack.append(expr)
+                continue
+            if paren:
+                assert len(stack) > 1
+                stack.pop()
+            else:
+                stack[-1].append(atom)
+            if len(stack) == 1:
+                break
+
+        assert len(stack) == 1 and len(stack[0]) == 1
+        return stack[0][0]
+
+    def bv_decode(self, v):
+        if v == "true": return 1, 1
+        if v == "false": return 0, 1
+        base, digit_width = bv_formats[v[:2]]
+        return int(v[2:], base), digit_width * (len(v) - 2)
 
     def bv2hex(self, v):
-        h = ""
-        v = bv2bin(v)
-        while len(v) > 0:
-            d = 0
-            if len(v) > 0 and v[-1] == "1": d += 1
-            if len(v) > 1 and v[-2] == "1": d += 2
-            if len(v) > 2 and v[-3] == "1": d += 4
-            if len(v) > 3 and v[-4] == "1": d += 8
-            h = hex(d)[2:] + h
-            if len(v) < 4: break
-            v = v[:-4]
-        return h
+        if v.startswith("#x"):
+            return v[2:].lower()
+        value, width = self.bv_decode(v)
+        return format(value, "0%dx" % ((width + 3) // 4))
 
     def bv2bin(self, v):
-        if v == "true": return "1"
-        if v == "false": return "0"
         if v.startswith("#b"):
             return v[2:]
-        if v.startswith("#x"):
-            digits = []
-            for d in v[2:]:
-                if d == "0": digits.append("0000")
-                if d == "1": digits.append("0001")
-                if d == "2": digits.append("0010")
-                if d == "3": digits.append("0011")
-                if d == "4": digits.append("0100")
-                if d == "5": digits.append("0101")
-                if d == "6": digits.append("0110")
-                if d == "7": digits.append("0111")
-                if d == "8": digits.append("1000")
-                if d == "9": digits.append("1001")
-                if d in ("a", "A"): digits.append("1010")
-                if d in ("b", "B"): digits.append("1011")
-                if d in ("c", "C"): digits.append("1100")
-                if d in ("d", "D"): digits.append("1101")
-                if d in ("e", "E"): digits.append("1110")
-                if d in ("f", "F"): digits.append("1111")
-            return "".join(digits)
-        assert False
+        value, width = self.bv_decode(v)
+        return format(value, "0%db" % width)
 
     def bv2int(self, v):
-        return int(self.bv2bin(v), 2)
+        return self.bv_decode(v)[0]
+
+    def decode_list(self, values, fmt="bin"):
+        decode = {"bin": self.bv2bin, "hex": self.bv2hex, "int": self.bv2int}[fmt]
+        return [decode(v) for v in values]
 
     def get(self, expr):
-        self.write("(get-value (%s))" % (expr))
-        return self.parse(self.read())[0][1]
+        return self.get_list([expr])[0]
 
     def get_list(self, expr_list):
         if len(expr_list) == 0:
             return []
-        self.write("(get-value (%s))" % " ".join(expr_list))
-        return [n[1] for n in self.parse(self.read())]
+        start = time()
+        with self.profile.span("get-value", count=len(expr_list)):
+            stmt = self.query("(get-value (%s))" % " ".join(expr_list))
+            solved = time()
+            values = [n[1] for n in self.parse(stmt)]
+        if self.stats_file is not None:
+            self.log_stats("get-value", solved - start, None, len(stmt), time() - solved)
+        return values
 
     def get_path(self, mod, path):
         assert mod in self.modinfo
@@ -341,45 +1369,32 @@ class smtio:
         return [".".join(path)]
 
     def net_expr(self, mod, base, path):
-        if len(path) == 1:
-            assert mod in self.modinfo
-            if path[0] in self.modinfo[mod].wsize:
-                return "(|%s_n %s| %s)" % (mod, path[0], base)
-            if path[0] in self.modinfo[mod].memories:
-                return "(|%s_m %s| %s)" % (mod, path[0], base)
-            assert 0
-
-        assert mod in self.modinfo
-        assert path[0] in self.modinfo[mod].cells
+        index = self.hierindex(mod)
+        path = tuple(path)
 
-        nextmod = self.modinfo[mod].cells[path[0]]
-        nextbase = "(|%s_h %s| %s)" % (mod, path[0], base)
-        return self.net_expr(nextmod, nextbase, path[1:])
+        if path in index.netmap:
+            leafmod, prefix, suffix = index.netmap[path][2]
+            return "(|%s_n %s| %s%s%s)" % (leafmod, path[-1], prefix, base, suffix)
 
-    def net_width(self, mod, net_path):
-        for i in range(len(net_path)-1):
-            assert mod in self.modinfo
-            assert net_path[i] in self.modinfo[mod].cells
-            mod = self.modinfo[mod].cells[net_path[i]]
+        if path in index.memmap:
+            leafmod, prefix, suffix = index.memmap[path][1]
+            return "(|%s_m %s| %s%s%s)" % (leafmod, path[-1], prefix, base, suffix)
 
-        assert mod in self.modinfo
-        assert net_path[-1] in self.modinfo[mod].wsize
-        return self.modinfo[mod].wsize[net_path[-1]]
+        assert 0
 
-    def mem_expr(self, mod, base, path, portidx=None, infomode=False):
-        if len(path) == 1:
-            assert mod in self.modinfo
-            assert path[0] in self.modinfo[mod].memories
-            if infomode:
-                return self.modinfo[mod].memories[path[0]]
-            return "(|%s_m%s %s| %s)" % (mod, "" if portidx is None else ":%d" % portidx, path[0], base)
+    def assert_expr(self, mod, base, path, assertfun):
+        assertinfo, (leafmod, prefix, suffix) = self.hierindex(mod).assertmap[(tuple(path), assertfun)]
+        return "(|%s| %s%s%s)" % (assertfun, prefix, base, suffix)
 
-        assert mod in self.modinfo
-        assert path[0] in self.modinfo[mod].cells
+    def net_width(self, mod, net_path):
+        return self.hierindex(mod).netmap[tuple(net_path)][1]
 
-        nextmod = self.modinfo[mod].cells[path[0]]
-        nextbase = "(|%s_h %s| %s)" % (mod, path[0], base)
-        return self.mem_expr(nextmod, nextbase, path[1:], portidx=portidx, infomode=infomode)
+    def mem_expr(self, mod, base, path, portidx=None, infomode=False):
+        path = tuple(path)
+        meminfo, (leafmod, prefix, suffix) = self.hierindex(mod).memmap[path]
+        if infomode:
+            return meminfo
+        return "(|%s_m%s %s| %s%s%s)" % (leafmod, "" if portidx is None else ":%d" % portidx, path[-1], prefix, base, suffix)
 
     def mem_info(self, mod, base, path):
         return self.mem_expr(mod, base, path, infomode=True)
@@ -394,26 +1409,402 @@ class smtio:
         return self.bv2hex(self.get_net(mod_name, net_path, state_name))
 
     def get_net_hex_list(self, mod_name, net_path_list, state_name):
-        return [self.bv2hex(v) for v in self.get_net_list(mod_name, net_path_list, state_name)]
+        return self.decode_list(self.get_net_list(mod_name, net_path_list, state_name), "hex")
 
     def get_net_bin(self, mod_name, net_path, state_name):
         return self.bv2bin(self.get_net(mod_name, net_path, state_name))
 
     def get_net_bin_list(self, mod_name, net_path_list, state_name):
-        return [self.bv2bin(v) for v in self.get_net_list(mod_name, net_path_list, state_name)]
+        return self.decode_list(self.get_net_list(mod_name, net_path_list, state_name), "bin")
 
     def wait(self):
-        self.p.wait()
+        self.flush()
+        if self.stream_hash is not None:
+            self.save_result()
+        for solver in self.solvers:
+            solver.wait()
+
+    def kill(self):
+        self.killed = True
+        for solver in self.solvers:
+            solver.kill()
+
+
+# smtio adds the pipelined *_future() queries to smtiobase. They are built on
+# the blocking reader, asyncsmtio awaits each query instead.
+class smtio(smtiobase):
+    def read(self):
+        if len(self.futures) != 0:
+            self.resolve()
+        return super().read()
+
+    def check_sat(self):
+        if len(self.futures) != 0:
+            self.resolve()
+        return super().check_sat()
+
+    def resolve(self, future=None):
+        self.flush()
+
+        while len(self.futures) != 0:
+            head = self.futures.popleft()
+            start = time()
+            with self.profile.span("solve" if head.sat else "get-value"):
+                if head.sat:
+                    stmt = self.wait_response(self.winner.reader.response)
+                    self.winner.pending -= 1
+                else:
+                    stmt = self.read_response(self.winner)
+                solved = time()
+                head.set(self.check_response(self.winner, stmt))
+            if self.stats_file is not None:
+                self.log_stats("check-sat" if head.sat else "get-value", solved - start,
+                        stmt if head.sat else None, len(stmt), time() - solved)
+            if head is future:
+                break
+
+    def queue(self, stmt, decode=None, sat=False):
+        future = smtfuture(self, decode, sat)
+
+        # in portfolio mode the winner of the next check-sat decides where
+        # queries go, so there is nothing to pipeline. with the result cache
+        # each reply is looked up on its own.
+        if len(self.solvers) > 1 or self.stream_hash is not None:
+            future.set(self.check_sat() if sat else self.query(stmt))
+            return future
+
+        if sat:
+            self.winner.pending += 1
+        if self.buffer_stmt(stmt):
+            self.flush()
+        self.futures.append(future)
+        return future
+
+    def check_sat_future(self):
+        return self.queue("(check-sat)", sat=True)
+
+    def get_future(self, expr):
+        return self.queue("(get-value (%s))" % (expr), lambda stmt: self.parse(stmt)[0][1])
+
+    def get_list_future(self, expr_list):
+        if len(expr_list) == 0:
+            future = smtfuture(self)
+            future.set([])
+            return future
+        return self.queue("(get-value (%s))" % " ".join(expr_list), lambda stmt: [n[1] for n in self.parse(stmt)])
+
+    def get_net_list_future(self, mod_name, net_path_list, state_name):
+        return self.get_list_future([self.net_expr(mod_name, state_name, n) for n in net_path_list])
+
+
+class asyncsmtsolver(smtsolverbase):
+    def __init__(self, name, mem_limit=None):
+        super().__init__(name)
+        self.mem_limit = mem_limit
+        self.p = None
+        self.writer = None
+        self.write_failed = False
+
+    async def start(self):
+        solver, address = solver_address(self.name)
+        if address is None:
+            self.p = await asyncio.create_subprocess_exec(*solver_command(self.name),
+                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                    preexec_fn=solver_limits(self.mem_limit))
+            self.stdin, self.stdout = self.p.stdin, self.p.stdout
+        else:
+            try:
+                if address.startswith("unix:"):
+                    self.stdout, self.stdin = await asyncio.open_unix_connection(address[len("unix:"):])
+                else:
+                    host, port = address.rsplit(":", 1)
+                    self.stdout, self.stdin = await asyncio.open_connection(host, int(port))
+            except OSError as e:
+                # asyncio reports "Connect call failed", the errno is the reason
+                server_error(solver, address, os.strerror(e.errno) if e.errno is not None else str(e))
+        self.writes = asyncio.Queue()
+        self.writer = asyncio.ensure_future(self.write_loop())
+        if address is not None:
+            await self.send(bytes(solver + "\n", "ascii"))
+            check_server_reply(solver, address, await self.stdout.readline())
+
+    # All data goes through the writer task. A portfolio solver that is still
+    # busy with an old check-sat does not read its input, send_nowait() leaves
+    # the data with its writer instead of waiting for the drain.
+    async def write_loop(self):
+        while True:
+            data = await self.writes.get()
+            try:
+                if data is not None and not self.write_failed:
+                    self.stdin.write(data)
+                    await self.stdin.drain()
+            except OSError:
+                self.write_failed = True
+            finally:
+                self.writes.task_done()
+            if data is None:
+                return
+
+    def send_nowait(self, data):
+        if self.write_failed:
+            raise self.terminated()
+        self.writes.put_nowait(data)
+
+    async def send(self, data):
+        self.send_nowait(data)
+        await self.writes.join()
+        if self.write_failed:
+            raise self.terminated()
+
+    async def receive(self, size):
+        data = await self.stdout.read(size)
+        if len(data) == 0:
+            raise self.terminated()
+        self.reader.feed(data)
+
+    async def wait(self):
+        if self.pending > 0:
+            self.kill()
+        elif not self.writer.done():
+            self.writes.put_nowait(None)
+            await self.writer
+        if self.p is not None:
+            self.stdin.close()
+            await self.p.wait()
+        elif not self.stdin.is_closing():
+            self.stdin.write_eof()
+            while len(await self.stdout.read(1 << 16)) != 0:
+                pass
+            self.stdin.close()
+
+    def kill(self):
+        if self.writer is not None:
+            self.writer.cancel()
+        if self.p is not None:
+            # not p.kill(): it reaps a solver that exited on its own behind
+            # the back of the asyncio child watcher
+            if self.p.returncode is None:
+                try:
+                    os.kill(self.p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        else:
+            self.stdin.close()
+
+
+# asyncio flavour of smtio: construct, then "await smt.start()". write, flush,
+# read, check_sat, get, get_list, get_net*, load_design and wait are coroutines,
+# parsing, bitvector decoding and the hierarchy helpers are shared with smtio.
+class asyncsmtio(smtiobase):
+    lazy_start = False
+
+    def start_solvers(self):
+        self.solvers = [asyncsmtsolver(name, self.mem_limit) for name in self.solver_names]
+        self.dropped = []
+        self.winner = self.solvers[0]
+
+    async def start(self):
+        for solver in self.solvers:
+            await solver.start()
+        self.p = self.winner.p
+
+    async def setup(self, logic="ALL", info=None):
+        await self.write("(set-logic %s)" % logic)
+        if info is not None:
+            await self.write("(set-info :source |%s|)" % info)
+            await self.write("(set-info :smt-lib-version 2.5)")
+            await self.write("(set-info :category \"industrial\")")
+
+    async def write(self, stmt):
+        if self.buffer_stmt(stmt):
+            await self.flush()
+
+    def write_raw(self, data, num_statements=1):
+        self.buffer_raw(data, num_statements)
+
+    async def flush(self, tail="", solvers=None):
+        data = self.take_write_buf(tail)
+        if data is not None:
+            for solver in list(self.solvers) if solvers is None else solvers:
+                if len(self.solvers) > 1:
+                    try:
+                        solver.send_nowait(data)
+                    except smtabort as e:
+                        if not self.drop_solver(solver, e):
+                            raise
+                else:
+                    await solver.send(data)
+
+    async def load_design(self, filename, topmod=None):
+        for _ in self.load_design_steps(filename, topmod):
+            await self.flush()
+
+    async def read(self):
+        await self.flush()
+
+        while True:
+            stmt = self.winner.reader.response()
+            if stmt is not None:
+                break
+            timeout = None if self.deadline is None else max(self.deadline - time(), 0)
+            try:
+                await asyncio.wait_for(self.winner.receive(self.read_chunk), timeout)
+            except asyncio.TimeoutError:
+                raise self.deadline_abort(self.deadline) from None
+
+        return self.check_response(self.winner, stmt)
+
+    async def query(self, stmt):
+        if len(self.solvers) > 1:
+            await self.flush()
+        self.buffer_stmt(stmt)
+        await self.flush(solvers=[self.winner])
+        return await self.read()
+
+    async def check_sat(self):
+        if self.debug_print:
+            print("> (check-sat)")
+        await self.flush("(check-sat)\n")
+        self.num_statements += 1
+
+        for solver in self.solvers:
+            solver.pending += 1
+
+        if self.debug_file:
+            print("; running check-sat..", file=self.debug_file)
+            self.debug_file.flush()
+
+        answers = dict()
+        receiving = dict()
+        deadline = self.query_deadline()
+
+        while True:
+            result = self.check_sat_poll(answers)
+            if result is not None:
+                break
+
+            for solver in self.solvers:
+                if solver.pending > 0 and solver not in receiving:
+                    receiving[solver] = asyncio.ensure_future(solver.receive(self.read_chunk))
+
+            timeout = None if deadline is None else max(deadline - time(), 0)
+            done, _ = await asyncio.wait(receiving.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                for task in receiving.values():
+                    task.cancel()
+                raise self.deadline_abort(deadline)
+            for solver, task in list(receiving.items()):
+                if task in done:
+                    del receiving[solver]
+                    try:
+                        task.result()
+                    except smtabort as e:
+                        if not self.drop_solver(solver, e):
+                            for task in receiving.values():
+                                task.cancel()
+                            raise
+
+        for task in receiving.values():
+            task.cancel()
+
+        if self.debug_file:
+            print("(set-info :status %s)" % result, file=self.debug_file)
+            print("(check-sat)", file=self.debug_file)
+            self.debug_file.flush()
+        return result
+
+    async def get(self, expr):
+        return self.parse(await self.query("(get-value (%s))" % (expr)))[0][1]
+
+    async def get_list(self, expr_list):
+        if len(expr_list) == 0:
+            return []
+        return [n[1] for n in self.parse(await self.query("(get-value (%s))" % " ".join(expr_list)))]
+
+    async def get_net_hex(self, mod_name, net_path, state_name):
+        return self.bv2hex(await self.get_net(mod_name, net_path, state_name))
+
+    async def get_net_hex_list(self, mod_name, net_path_list, state_name):
+        return self.decode_list(await self.get_net_list(mod_name, net_path_list, state_name), "hex")
+
+    async def get_net_bin(self, mod_name, net_path, state_name):
+        return self.bv2bin(await self.get_net(mod_name, net_path, state_name))
+
+    async def get_net_bin_list(self, mod_name, net_path_list, state_name):
+        return self.decode_list(await self.get_net_list(mod_name, net_path_list, state_name), "bin")
+
+    async def wait(self):
+        await self.flush()
+        for solver in self.solvers:
+            await solver.wait()
+
+
+# N solver processes that share one parsed design. Sessions keep their solver
+# state between acquire() and release(), use (push)/(pop) for scratch work.
+class smtpool:
+    def __init__(self, num_solvers, opts=None, logic="QF_AUFBV"):
+        self.sessions = list()
+        for i in range(num_solvers):
+            smt = smtio(opts=opts, debug_file=False if i > 0 else None, timeinfo=False if num_solvers > 1 else None)
+            smt.setup(logic)
+            self.sessions.append(smt)
+        self.idle = list(reversed(self.sessions))
+        self.cond = threading.Condition()
+
+    def load_design(self, filename, topmod=None):
+        self.sessions[0].load_design(filename, topmod, mirrors=self.sessions[1:])
+
+    @property
+    def modinfo(self):
+        return self.sessions[0].modinfo
+
+    @property
+    def topmod(self):
+        return self.sessions[0].topmod
+
+    def acquire(self):
+        with self.cond:
+            while len(self.idle) == 0:
+                self.cond.wait()
+            return self.idle.pop()
+
+    def release(self, smt):
+        with self.cond:
+            self.idle.append(smt)
+            self.cond.notify()
+
+    @contextmanager
+    def session(self):
+        smt = self.acquire()
+        try:
+            yield smt
+        finally:
+            self.release(smt)
+
+    def wait(self):
+        for smt in self.sessions:
+            smt.write("(exit)")
+        for smt in self.sessions:
+            smt.wait()
 
 
 class smtopts:
     def __init__(self):
         self.shortopts = "s:v"
-        self.longopts = ["no-progress", "dump-smt2="]
+        self.longopts = ["no-progress", "dump-smt2=", "cache-dir=", "cache-results", "cache-size=", "timeout=", "query-timeout=", "solver-mem=", "stats-json=", "profile-trace="]
         self.solver = "z3"
         self.debug_print = False
         self.debug_file = None
         self.timeinfo = True
+        self.cache_dir = None
+        self.cache_results = False
+        self.cache_size = 256 << 20
+        self.timeout = None
+        self.query_timeout = None
+        self.mem_limit = None
+        self.stats_file = None
+        self.profile_trace = None
+        self.profile = smtprofile()
 
     def handle(self, o, a):
         if o == "-s":
@@ -424,6 +1815,23 @@ class smtopts:
             self.timeinfo = True
         elif o == "--dump-smt2":
             self.debug_file = open(a, "w")
+        elif o == "--cache-dir":
+            self.cache_dir = a
+        elif o == "--cache-results":
+            self.cache_results = True
+        elif o == "--cache-size":
+            self.cache_size = int(a) << 20
+        elif o == "--timeout":
+            self.timeout = int(a)
+        elif o == "--query-timeout":
+            self.query_timeout = int(a)
+        elif o == "--solver-mem":
+            self.mem_limit = int(a) << 20
+        elif o == "--stats-json":
+            self.stats_file = open(a, "w")
+        elif o == "--profile-trace":
+            self.profile_trace = a
+            self.profile.enabled = True
         else:
             return False
         return True
@@ -432,8 +1840,17 @@ class smtopts:
         return """
     -s <solver>
         set SMT solver: z3, cvc4, yices, mathsat
+        any other name is run as a command that reads SMT-LIB2 from stdin
         default: z3
 
+    -s portfolio:<solver>,<solver>,..
+        run several solvers on the same problem. each check-sat returns
+        the first sat/unsat answer and the model is read from that solver.
+
+    -s <solver>@<host>:<port>
+    -s <solver>@unix:<path>
+        run the solver on a yosys-smtserver reachable at this address
+
     -v
         enable debug output
 
@@ -442,47 +1859,112 @@ class smtopts:
 
     --dump-smt2 <filename>
         write smt2 statements to file
+
+    --cache-dir <dirname>
+        cache the parsed design info in this directory. a new directory
+        is only accessible by the current user. anyone who can write to
+        it can change what smtbmc reads back, do not share it with
+        untrusted users.
+
+    --cache-results
+        also cache the solver answers in the --cache-dir directory.
+        answers are keyed by a hash of all commands sent up to each
+        check-sat and get-value; the solver is only started when an
+        answer is missing. until then everything sent is kept in
+        memory. (no portfolio runs, and the cache does not notice
+        when the solver binary changes.)
+
+    --cache-size <megabytes>
+        evict least recently used cache entries when the cache
+        directory grows beyond this size
+        default: 256
+
+    --timeout <seconds>
+        give up when the total run time exceeds this limit
+
+    --query-timeout <seconds>
+        give up when a single check-sat takes longer than this
+
+    --solver-mem <megabytes>
+        limit the address space of each solver process
+
+    --stats-json <filename>
+        write one JSON record per check-sat and get-value to this file
+
+    --profile-trace <filename>
+        write the time spent in each phase (loading, unrolling, solving,
+        model extraction, trace writing) in Chrome trace-event format
 """
 
 
+# shortest printable VCD identifier for net number n, "!" is the clock
+def vcd_ident(n):
+    ident = ""
+    while True:
+        ident += chr(33 + n % 94)
+        n //= 94
+        if n == 0:
+            return ident
+        n -= 1
+
+
+# Only value changes are written. The changes set for one time step are
+# collected and written with the marker of the next step, so a trace must
+# end with a set_time() call.
 class mkvcd:
     def __init__(self, f):
         self.f = f
         self.t = -1
         self.nets = dict()
+        self.keys = list()
+        self.widths = list()
+        self.values = list()
+        self.changes = list()
 
     def add_net(self, path, width):
         path = tuple(path)
         assert self.t == -1
-        key = "n%d" % len(self.nets)
-        self.nets[path] = (key, width)
-
-    def set_net(self, path, bits):
-        path = tuple(path)
+        handle = len(self.keys)
+        self.nets[path] = handle
+        self.keys.append(vcd_ident(handle + 1))
+        self.widths.append(width)
+        self.values.append(None)
+        return handle
+
+    def set_net(self, net, bits):
         assert self.t >= 0
-        assert path in self.nets
-        print("b%s %s" % (bits, self.nets[path][0]), file=self.f)
+        if not isinstance(net, int):
+            net = self.nets[tuple(net)]
+        if self.values[net] == bits:
+            return
+        self.values[net] = bits
+        if self.widths[net] == 1:
+            self.changes.append("%s%s\n" % (bits, self.keys[net]))
+        else:
+            self.changes.append("b%s %s\n" % (bits.lstrip("0") or "0", self.keys[net]))
 
     def set_time(self, t):
         assert t >= self.t
         if t != self.t:
             if self.t == -1:
-                print("$var event 1 ! smt_clock $end", file=self.f)
+                lines = ["$var event 1 ! smt_clock $end\n"]
                 scope = []
                 for path in sorted(self.nets):
                     while len(scope)+1 > len(path) or (len(scope) > 0 and scope[-1] != path[len(scope)-1]):
-                        print("$upscope $end", file=self.f)
+                        lines.append("$upscope $end\n")
                         scope = scope[:-1]
                     while len(scope)+1 < len(path):
-                        print("$scope module %s $end" % path[len(scope)], file=self.f)
+                        lines.append("$scope module %s $end\n" % path[len(scope)])
                         scope.append(path[len(scope)-1])
-                    key, width = self.nets[path]
-                    print("$var wire %d %s %s $end" % (width, key, path[-1]), file=self.f)
+                    net = self.nets[path]
+                    lines.append("$var wire %d %s %s $end\n" % (self.widths[net], self.keys[net], path[-1]))
                 for i in range(len(scope)):
-                    print("$upscope $end", file=self.f)
-                print("$enddefinitions $end", file=self.f)
+                    lines.append("$upscope $end\n")
+                lines.append("$enddefinitions $end\n")
+                self.f.write("".join(lines))
             self.t = t
             assert self.t >= 0
-            print("#%d" % self.t, file=self.f)
-            print("1!", file=self.f)
+            self.changes.append("#%d\n1!\n" % self.t)
+            self.f.write("".join(self.changes))
+            self.changes = list()
 
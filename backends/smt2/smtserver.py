@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# yosys -- Yosys Open SYnthesis Suite
+#
+# Copyright (C) 2012  Clifford Wolf <clifford@clifford.at>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+import os, sys, getopt, select, socket, socketserver, subprocess, threading
+##yosys-sys-path##
+from smtio import solver_commands, solver_command, solver_limits
+
+allowed = set(solver_commands.keys())
+mem_limit = None
+verbose = False
+
+
+def usage():
+    print("""
+yosys-smtserver [options] <host>:<port>
+yosys-smtserver [options] unix:<path>
+
+    run SMT solvers for clients connecting to this address, for example
+    'yosys-smtbmc -s z3@<host>:<port>'. each connection starts one solver
+    process and streams SMT-LIB2 to and from it.
+
+    --allow <command>
+        also allow clients to run this solver command. by default only
+        the built-in solver names (%s) are accepted.
+
+    --solver-mem <megabytes>
+        limit the address space of each solver process
+
+    -v
+        log connections
+""" % ", ".join(sorted(solver_commands.keys())))
+    sys.exit(1)
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "v", ["allow=", "solver-mem="])
+except:
+    usage()
+
+for o, a in opts:
+    if o == "--allow":
+        allowed.add(a)
+    elif o == "--solver-mem":
+        mem_limit = int(a) << 20
+    elif o == "-v":
+        verbose = True
+    else:
+        usage()
+
+if len(args) != 1:
+    usage()
+
+
+class handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+
+        # the first line names the solver and is answered with "ok" or an
+        # (error ...), the rest goes to its stdin
+        data = b""
+        while b"\n" not in data:
+            chunk = sock.recv(1 << 16)
+            if len(chunk) == 0:
+                return
+            data += chunk
+        name, data = data.split(b"\n", 1)
+        name = name.decode("ascii", errors="replace")
+
+        if name not in allowed:
+            if verbose:
+                print("Rejected solver '%s' from %s." % (name, self.client_address or "unix socket"), flush=True)
+            sock.sendall(bytes("(error \"solver '%s' is not allowed on this server\")\n" % name, "ascii"))
+            return
+
+        if verbose:
+            print("Starting %s for %s." % (name, self.client_address or "unix socket"), flush=True)
+
+        try:
+            p = subprocess.Popen(solver_command(name), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    preexec_fn=solver_limits(mem_limit))
+        except OSError as e:
+            if verbose:
+                print("Failed to start %s for %s: %s" % (name, self.client_address or "unix socket", e), flush=True)
+            sock.sendall(bytes("(error \"solver '%s' could not be started: %s\")\n" % (name, e.strerror), "ascii"))
+            return
+
+        # the client waits for this line before it sends the design
+        sock.sendall(b"ok\n")
+
+        def pump_output():
+            try:
+                for data in iter(lambda: os.read(p.stdout.fileno(), 1 << 16), b""):
+                    sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                p.kill()
+
+        output_thread = threading.Thread(target=pump_output, daemon=True)
+        output_thread.start()
+
+        try:
+            while True:
+                p.stdin.write(data)
+                p.stdin.flush()
+                data = sock.recv(1 << 16)
+                if len(data) == 0:
+                    break
+            p.stdin.close()
+
+            # the client shuts down its side when it is done and then reads until
+            # the solver has exited. a client that goes away (hangup or reset)
+            # takes the solver with it.
+            poller = select.poll()
+            poller.register(sock, 0)
+            while p.poll() is None:
+                if len(poller.poll(100)) != 0:
+                    p.kill()
+        except OSError:
+            p.kill()
+
+        p.wait()
+        output_thread.join()
+
+        if verbose:
+            print("Solver %s for %s exited with status %d." % (name, self.client_address or "unix socket", p.returncode), flush=True)
+
+
+address = args[0]
+
+if address.startswith("unix:"):
+    path = address[len("unix:"):]
+    if os.path.exists(path):
+        os.unlink(path)
+    server_class = socketserver.ThreadingUnixStreamServer
+    server_address = path
+else:
+    host, port = address.rsplit(":", 1)
+    server_class = socketserver.ThreadingTCPServer
+    server_address = (host, int(port))
+
+server_class.daemon_threads = True
+server_class.allow_reuse_address = True
+
+with server_class(server_address, handler) as server:
+    print("Listening on %s." % address, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass